@@ -1,142 +1,2326 @@
 #!/usr/bin/env python3
-import multiprocessing
 import os
-import glob
 import mimetypes
 import time
 import argparse
+import io
+import asyncio
 import tempfile
-import json
+import hashlib
+import sqlite3
+import dataclasses
+import math
+import datetime
+import re
+import collections
+import threading
+import random
+import select
+import ctypes
+import ctypes.util
+import mmap
+import heapq
+import multiprocessing
+import codecs
+import socket
+import http.client
 import google.generativeai as genai
+import requests
 from google.api_core import exceptions as google_exceptions
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 
 SUPPORTED_MIME_TYPES = ['text/plain']
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ai-testing')
+TRUNCATION_NOTE = "Note: This file has been truncated"
+MANIFEST_EXPIRY_MARGIN = 15 * 60  # Don't reuse remote files that would expire during the session
+COUNT_BATCH_MAX_FILES = 100
+COUNT_BATCH_MAX_CHARS = 4 * 1024 * 1024  # Keep count_tokens requests well below the API request size limit
+TAIL_BLOCK_SIZE = 64 * 1024
+MAX_UNTRUNCATED_BYTES = 104800  # Larger files are cut to a tail unless a content mode sizes them
+DEFAULT_TAIL_LINES = 75
+CONCURRENCY_WINDOW = 50  # Recent requests the concurrency controller bases its decisions on
+CONCURRENCY_DECREASE_FACTOR = 0.5  # Multiplicative decrease on throttling
+CONCURRENCY_LATENCY_TOLERANCE = 2.0  # Back off when median latency exceeds this multiple of the best seen
+CONCURRENCY_MIN_SUCCESS_RATE = 0.8
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRY_MAX_WAIT = 80
+CIRCUIT_BREAKER_THRESHOLD = 8  # Consecutive server/connection failures across all workers before pausing
+CIRCUIT_BREAKER_COOLDOWN = 30
+DEFAULT_EXCLUDES = ['.*']  # Hidden files and directories, matching glob's '**' semantics
+SCAN_QUEUE_BATCHES = 64  # Directory batches buffered between the scanner threads and the planner
+DEFAULT_TOKEN_BUDGET = 2000000
+FAST_PATH_BUDGET_SHARE = 0.25  # Budget share committed in arrival order before value-based selection sees the whole corpus
+KNAPSACK_MAX_ITEMS = 1000  # Above this, every file is small next to the budget and greedy-by-density is near optimal
+KNAPSACK_RESOLUTION = 2000  # Capacity steps for the dynamic-programming knapsack
+RECENCY_HALF_LIFE = 24 * 3600
+WATER_FILL_MIN_TOKENS = 500  # Smallest tail window worth giving a file; below this, low-value files are dropped instead
+WATER_FILL_HEADER_CHARS = 300  # Allowance for the metadata header when sizing a tail window
+TOKEN_CAP_FIT_ROUNDS = 3  # Exact counts spent resizing a capped file towards its cap
+TOKEN_CAP_FILL = 0.9  # A capped file counted at this share of the cap or more is left as it is
+TOKEN_CAP_TARGET = 0.95  # Share of the cap a resized window aims for, leaving room for the count to vary
+ANSI_PATTERN = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]')
+CONTROL_PATTERN = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+INNER_WHITESPACE_PATTERN = re.compile(r'(?<=\S)[ \t]{2,}')
+TIMESTAMP_PATTERN = re.compile(r'\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?\b')
+LONG_ID_PATTERN = re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b|\b(?=[0-9a-fA-F]*[a-fA-F])(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{16,}\b')
+ERROR_LINE_PATTERN = re.compile(r'\b(error|fatal|critical|exception|traceback|panic)\b', re.IGNORECASE)
+DIGIT_PATTERN = re.compile(r'\d+')
+TEMPLATE_TREE_DEPTH = 4  # Token count plus the first two tokens pick the group of templates a line is compared against
+TEMPLATE_SIMILARITY = 0.5
+TEMPLATE_MAX_CHILDREN = 100
+TEMPLATE_MAX_CLUSTERS = 5000  # Least recently matched templates are dropped beyond this to bound memory
+TEMPLATE_MAX_LINE_CHARS = 2000
+TEMPLATE_RARE_COUNT = 3  # Templates seen this often or less are shown as their original lines
+TEMPLATE_SAMPLES = 3
+NEAR_DUPLICATE_PERMUTATIONS = 64
+NEAR_DUPLICATE_BANDS = 8  # Bands of 8 rows make files about 77% similar collide half the time
+NEAR_DUPLICATE_THRESHOLD = 0.8  # Estimated Jaccard similarity of line sets to count as near-duplicates
+NEAR_DUPLICATE_MAX_DIFF_RATIO = 0.5  # A diff must at least halve a file to be worth tying it to its representative
+MERSENNE_PRIME = (1 << 61) - 1
+EXCERPT_DEFAULT_PATTERNS = [r'\b(?:ERROR|FATAL|CRITICAL|SEVERE)\b', r'Traceback \(most recent call last\)', r'\bpanic:',
+                            r'\bOOM\b|[Oo]ut of memory|OutOfMemoryError', r'\b\w+(?:Exception|Error):']
+EXCERPT_HEAD_LINES = 20
+EXCERPT_TAIL_LINES = 50
+EXCERPT_MAX_LINE_CHARS = 1000
+TIME_SAMPLE_BYTES = 64 * 1024  # Read from the start of a file to detect its timestamp format
+TIME_SEARCH_MAX_LINES = 1000  # Lines without a timestamp to skip past before giving up on a probe
+TIMELINE_MAX_CHARS = 1024 * 1024  # Size of each merged timeline document
+LINE_RANGE_PATTERN = re.compile(r'^\[lines \d+-\d+\]$')
+SUMMARY_MAX_INPUT_BYTES = 2 * 1024 * 1024  # Only the tail of larger files is summarized
+SUMMARY_MAX_OUTPUT_TOKENS = 2048
+SUMMARY_MIN_BYTES = 16 * 1024  # Segments smaller than this cost less to upload than to summarize
+SUMMARY_PROMPT = ("Summarize this log file for an engineer investigating an incident. Keep error messages, exception types, "
+                  "timestamps of key events, identifiers and hostnames verbatim, and give counts for repeated events. Be concise.")
+GREP_MAX_CHARS = MAX_UNTRUNCATED_BYTES  # Matching windows kept per file, the same size a whole file may have
+LINE_COUNT_BLOCK_SIZE = 1024 * 1024
+SNIFF_BYTES = 8192  # Read from the start of each file to tell text from binary
+SNIFF_MAX_NUL_RATIO = 0.01
+SNIFF_MAX_CONTROL_RATIO = 0.1  # Control characters and invalid UTF-8 sequences, after ANSI color codes are removed
+TEXT_BOMS = [(codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF32_LE, 'utf-32-le'), (codecs.BOM_UTF32_BE, 'utf-32-be'),
+             (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be')]  # UTF-32 first: its little-endian BOM starts with UTF-16's
+ESTIMATOR_MIN_SAMPLES = 5  # Exact counts needed per file type before its estimates are trusted
+ESTIMATOR_DEFAULT_RATIO = 0.25  # Tokens per character for file types with no calibration yet
+ESTIMATOR_DEFAULT_ERROR = 0.5
+
+
+class UploadManifest:
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'manifest.sqlite3')
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "key TEXT PRIMARY KEY, name TEXT NOT NULL, display_name TEXT, "
+            "tokens INTEGER NOT NULL, expires REAL NOT NULL, created REAL NOT NULL, upper INTEGER)"
+        )
+        # Manifests written before estimates were told apart from exact counts
+        if 'upper' not in [column[1] for column in self.conn.execute("PRAGMA table_info(uploads)")]:
+            self.conn.execute("ALTER TABLE uploads ADD COLUMN upper INTEGER")
+        self.conn.commit()
+        self.live_files = {}
+
+    def lookup(self, key):
+        # upper is NULL for exact counts and the worst case of an estimate otherwise
+        row = self.conn.execute(
+            "SELECT name, tokens, upper FROM uploads WHERE key = ? AND expires > ?",
+            (key, time.time() + MANIFEST_EXPIRY_MARGIN),
+        ).fetchone()
+        return row
+
+    def record(self, key, file_response, tokens, upper=None):
+        expires = file_response.expiration_time.timestamp() if file_response.expiration_time else time.time() + 47 * 3600
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO uploads (key, name, display_name, tokens, expires, created, upper) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, file_response.name, file_response.display_name, tokens, expires, time.time(), upper),
+            )
+
+    def forget(self, name):
+        with self.conn:
+            self.conn.execute("DELETE FROM uploads WHERE name = ?", (name,))
+
+    def validate(self, live_files):
+        # Returns the live remote files by name, so reusing one needs no get_file call of its own
+        self.live_files = {file.name: file for file in live_files}
+        live = {file.name: file.expiration_time.timestamp() for file in live_files if file.expiration_time}
+        rows = self.conn.execute("SELECT key, name FROM uploads").fetchall()
+        stale = [(key,) for key, name in rows if name not in live]
+        with self.conn:
+            self.conn.executemany("DELETE FROM uploads WHERE key = ?", stale)
+            self.conn.executemany("UPDATE uploads SET expires = ? WHERE name = ?", [(expires, name) for name, expires in live.items()])
+            self.conn.execute("DELETE FROM uploads WHERE expires <= ?", (time.time(),))
+        return self.live_files
+
+    def close(self):
+        self.conn.close()
+
+
+class TokenEstimator:
+    def __init__(self, cache_dir=None):
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, 'manifest.sqlite3')
+        else:
+            self.path = ':memory:'
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_calibration ("
+            "file_type TEXT PRIMARY KEY, samples INTEGER NOT NULL, ratio_sum REAL NOT NULL, ratio_sq_sum REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self.stats = {
+            file_type: (samples, ratio_sum, ratio_sq_sum)
+            for file_type, samples, ratio_sum, ratio_sq_sum in self.conn.execute("SELECT * FROM token_calibration")
+        }
+
+    @staticmethod
+    def file_type(filepath, mime_type):
+        # Rotated logs (app.log.1, app.log.2.gz) share the calibration of their base extension
+        name = re.sub(r'(\.\d+)?(\.gz)?$', '', os.path.basename(filepath).lower())
+        extension = os.path.splitext(name)[1]
+        return extension or mime_type
+
+    def is_calibrated(self, file_type):
+        return self.stats.get(file_type, (0, 0, 0))[0] >= ESTIMATOR_MIN_SAMPLES
+
+    def add_sample(self, file_type, chars, tokens):
+        if chars <= 0:
+            return
+        ratio = tokens / chars
+        samples, ratio_sum, ratio_sq_sum = self.stats.get(file_type, (0, 0.0, 0.0))
+        self.stats[file_type] = (samples + 1, ratio_sum + ratio, ratio_sq_sum + ratio * ratio)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO token_calibration VALUES (?, ?, ?, ?)",
+                (file_type,) + self.stats[file_type],
+            )
+
+    def ratio(self, file_type):
+        samples, ratio_sum, ratio_sq_sum = self.stats.get(file_type, (0, 0.0, 0.0))
+        if samples < ESTIMATOR_MIN_SAMPLES:
+            return ESTIMATOR_DEFAULT_RATIO, ESTIMATOR_DEFAULT_ERROR
+        mean = ratio_sum / samples
+        variance = max(0.0, ratio_sq_sum / samples - mean * mean) * samples / (samples - 1)
+        # Two standard deviations covers ~95% of files of this type
+        return mean, min(ESTIMATOR_DEFAULT_ERROR, 2 * math.sqrt(variance) / mean) if mean else ESTIMATOR_DEFAULT_ERROR
+
+    def estimate(self, file_type, chars):
+        ratio, error = self.ratio(file_type)
+        tokens = chars * ratio
+        return round(tokens), math.floor(tokens * (1 - error)), math.ceil(tokens * (1 + error))
+
+    def report(self, file_types):
+        for file_type in sorted(file_types):
+            samples = self.stats.get(file_type, (0,))[0]
+            ratio, error = self.ratio(file_type)
+            status = f"n={samples}" if samples >= ESTIMATOR_MIN_SAMPLES else f"uncalibrated, n={samples}"
+            print(f"Token estimator {file_type}: {1 / ratio:.2f} chars/token ±{error * 100:.0f}% ({status})")
+
+    def close(self):
+        self.conn.close()
+
+
+class RateLimiter:
+    BUCKETS = ('requests', 'bytes', 'tokens')
+
+    def __init__(self):
+        self.per_minute = {}
+        self.path = None
+        self.local = threading.local()
+
+    def configure(self, state_dir, requests_per_minute=None, bytes_per_minute=None, tokens_per_minute=None):
+        # Bucket levels live in SQLite so every gemini.py process on the host draws from the same quota
+        limits = dict(zip(self.BUCKETS, (requests_per_minute, bytes_per_minute, tokens_per_minute)))
+        self.per_minute = {name: limit for name, limit in limits.items() if limit}
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, 'ratelimit.sqlite3')
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+            self.local.conn = conn
+        return conn
+
+    def acquire(self, requests=1, bytes=0, tokens=0):
+        if not self.per_minute:
+            return
+        # A single request larger than a bucket's capacity waits for a full bucket instead of forever
+        costs = {name: min(cost, self.per_minute[name]) for name, cost in zip(self.BUCKETS, (requests, bytes, tokens)) if name in self.per_minute and cost > 0}
+        conn = self._connection()
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                levels = {}
+                wait_time = 0.0
+                for name, cost in costs.items():
+                    rate = self.per_minute[name] / 60
+                    row = conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                    level = self.per_minute[name] if row is None else min(self.per_minute[name], row[0] + (now - row[1]) * rate)
+                    levels[name] = level
+                    if level < cost:
+                        wait_time = max(wait_time, (cost - level) / rate)
+                if wait_time == 0:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                        [(name, levels[name] - cost, now) for name, cost in costs.items()],
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+
+rate_limiter = RateLimiter()
+
+
+def http_status(error):
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code
+    # Uploads go through googleapiclient, whose HttpError carries the status on .resp
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+def is_throttling_error(error):
+    return http_status(error) in (429, 503)
+
+def is_retryable_error(error):
+    if isinstance(error, (google_exceptions.Aborted, google_exceptions.RetryError)):
+        return True
+    status = http_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # Connection resets, timeouts and DNS failures below the API layer are transient; anything
+    # else (bad MIME type, invalid arguments, missing or unreadable local files) will fail the same way again
+    return isinstance(error, (ConnectionError, TimeoutError, socket.gaierror, http.client.HTTPException,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def retry_hint(error):
+    for detail in getattr(error, 'details', None) or ():
+        delay = getattr(detail, 'retry_delay', None)
+        if delay:
+            return delay.total_seconds() if hasattr(delay, 'total_seconds') else delay.seconds + delay.nanos / 1e9
+    for response in (getattr(error, 'resp', None), getattr(error, 'response', None)):
+        headers = getattr(response, 'headers', response)
+        value = headers.get('retry-after') if hasattr(headers, 'get') else None
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+class RetryPolicy:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = CIRCUIT_BREAKER_COOLDOWN
+        self.probing = False
+
+    def before_attempt(self):
+        # While the circuit is open every worker waits; once it expires a single probe goes through
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.open_until:
+                    self.lock.wait(self.open_until - now)
+                elif self.open_until and self.probing:
+                    self.lock.wait()
+                else:
+                    if self.open_until:
+                        self.probing = True
+                    return
+
+    def record_success(self):
+        with self.lock:
+            if self.open_until:
+                print("Backend recovered, resuming all workers")
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+            self.cooldown = CIRCUIT_BREAKER_COOLDOWN
+            self.probing = False
+            self.lock.notify_all()
+
+    def _record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.probing or self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD:
+                if self.probing:
+                    self.cooldown = min(self.cooldown * 2, 10 * CIRCUIT_BREAKER_COOLDOWN)
+                print(f"Backend appears to be down, pausing all workers for {self.cooldown} seconds")
+                self.open_until = time.monotonic() + self.cooldown
+                self.probing = False
+                self.lock.notify_all()
+
+    def next_wait(self, error, attempt, max_retries, previous_wait, base_wait_time):
+        if not is_retryable_error(error):
+            print(f"Not retrying: {type(error).__name__} is not a transient error")
+            if self.probing:
+                self.record_success()
+            return None
+        # A 503 slows the concurrency controller down like a 429, but a backend that answers
+        # nothing else is down, so only a 429 proves the backend is up
+        if http_status(error) != 429:
+            self._record_failure()
+        elif self.probing:
+            self.record_success()
+        if attempt >= max_retries - 1:
+            return None
+        # Decorrelated jitter keeps workers that failed together from retrying in lockstep
+        wait_time = min(RETRY_MAX_WAIT, random.uniform(base_wait_time, previous_wait * 3))
+        hint = retry_hint(error)
+        if hint is not None:
+            wait_time = max(wait_time, hint)
+        return wait_time
+
+
+retry_policy = RetryPolicy()
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial, maximum, minimum=1):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.peak = self.limit
+        self.waiters = collections.deque()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=CONCURRENCY_WINDOW))
+        self.outcomes = collections.deque(maxlen=CONCURRENCY_WINDOW)
+        self.best_median = {}
+        self.successes_since_change = 0
+        self.throttled = 0
+        self.last_decrease = 0.0
+        self.loop = asyncio.get_running_loop()
+
+    async def __aenter__(self):
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return self
+        waiter = self.loop.create_future()
+        self.waiters.append(waiter)
+        await waiter
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.in_flight < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def observer(self, kind):
+        # Called from worker threads for every API attempt, including retried ones.
+        # Latency baselines are tracked per kind since uploads and token counts differ widely.
+        def observe(latency, error=None):
+            self.loop.call_soon_threadsafe(self._observe, kind, latency, error)
+        return observe
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        # One decrease per round of in-flight requests, so a burst of 429s doesn't collapse the limit to 1
+        if now - self.last_decrease < max(self.percentile(kind, 0.5) for kind in self.latencies):
+            return
+        self.limit = max(self.minimum, math.floor(self.limit * factor))
+        self.last_decrease = now
+        self.successes_since_change = 0
+
+    def _observe(self, kind, latency, error):
+        self.latencies[kind].append(latency)
+        self.outcomes.append(error is None)
+        if error is not None:
+            if is_throttling_error(error):
+                self.throttled += 1
+                self._decrease(CONCURRENCY_DECREASE_FACTOR)
+            elif len(self.outcomes) >= CONCURRENCY_WINDOW // 2 and sum(self.outcomes) / len(self.outcomes) < CONCURRENCY_MIN_SUCCESS_RATE:
+                self._decrease(1 - (1 - CONCURRENCY_DECREASE_FACTOR) / 2)
+            return
+
+        self.successes_since_change += 1
+        if self.successes_since_change < self.limit:
+            return
+        # A full round of successes: check latency before growing
+        median = self.percentile(kind, 0.5)
+        if len(self.latencies[kind]) >= CONCURRENCY_WINDOW // 2:
+            self.best_median[kind] = min(median, self.best_median.get(kind, median))
+        if kind in self.best_median and median > self.best_median[kind] * CONCURRENCY_LATENCY_TOLERANCE:
+            self._decrease(1 - (1 - CONCURRENCY_DECREASE_FACTOR) / 2)
+        elif self.limit < self.maximum:
+            self.limit += 1
+            self.peak = max(self.peak, self.limit)
+            self.successes_since_change = 0
+            self._wake()
+
+    def percentile(self, kind, fraction):
+        if not self.latencies[kind]:
+            return 0.0
+        ordered = sorted(self.latencies[kind])
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def report(self):
+        latencies = ", ".join(
+            f"{kind} p50 {self.percentile(kind, 0.5):.2f}s p95 {self.percentile(kind, 0.95):.2f}s" for kind in sorted(self.latencies)
+        )
+        print(f"Concurrency settled at {self.limit} in-flight requests "
+              f"(peak {self.peak}, {self.throttled} throttled{', ' + latencies if latencies else ''})")
+
+
+def manifest_key(full_content, mime_type):
+    # The prepared content already reflects how the file was cut, so it and the MIME type identify an upload
+    digest = hashlib.sha256(full_content.encode('utf-8', errors='replace')).hexdigest()
+    return f"{digest}:{mime_type}"
+
+def file_digest(filepath, start=0, end=None, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        file.seek(start)
+        remaining = math.inf if end is None else end - start
+        while remaining > 0 and (block := file.read(min(block_size, remaining))):
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+def with_aliases(full_content, aliases):
+    # Lists the other paths holding the same bytes in the metadata header of the one upload
+    if not aliases:
+        return full_content
+    metadata, separator, body = full_content.partition('\n\n')
+    return metadata + f"\nIdentical Copies: {', '.join(aliases)}\n" + separator + body
 
 def get_mime_type(filepath):
     mime_type, _ = mimetypes.guess_type(filepath)
     return mime_type if mime_type in SUPPORTED_MIME_TYPES else 'text/plain'
 
-def truncate_file(filepath, max_lines=100):
+def sniff_file(filepath):
+    # Returns why a file can't be uploaded as text, or None if it can
+    with open(filepath, 'rb') as file:
+        sample = file.read(SNIFF_BYTES)
+    if any(sample.startswith(bom) for bom, encoding in TEXT_BOMS):
+        return None
+    if sample.count(0) > len(sample) * SNIFF_MAX_NUL_RATIO:
+        return 'binary'
+    # The sample may end inside a multi-byte character, so the decoder isn't told it has all the input
+    text = ANSI_PATTERN.sub('', codecs.getincrementaldecoder('utf-8')('replace').decode(sample, final=False))
+    if text.count('\ufffd') + len(CONTROL_PATTERN.findall(text)) > len(text) * SNIFF_MAX_CONTROL_RATIO:
+        # Latin-1 and Windows code page text only fails as UTF-8; random bytes are full of control characters either way
+        text = ANSI_PATTERN.sub('', sample.decode('cp1252', errors='replace'))
+        if text.count('\ufffd') + len(CONTROL_PATTERN.findall(text)) > len(text) * SNIFF_MAX_CONTROL_RATIO:
+            return 'binary'
+        return 'non-UTF-8'
+    return None
+
+def bom_encoding(filepath):
+    # The encoding a byte order mark declares; files without one are read as UTF-8
+    with open(filepath, 'rb') as file:
+        head = file.read(4)
+    return next((encoding for bom, encoding in TEXT_BOMS if head.startswith(bom)), None)
+
+def prepare_wide_text(filepath, encoding, tail_bytes=None):
+    # UTF-16 and UTF-32 have no byte-sized line breaks for the readers that seek and grep by byte offset,
+    # so these files are decoded whole, or from a tail aligned to the code unit, and shown as they are
+    width = 4 if encoding.startswith('utf-32') else 2
+    max_chars = tail_bytes or MAX_UNTRUNCATED_BYTES
+    with open(filepath, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        start = max(width, (size - max_chars * width) // width * width)
+        file.seek(start)
+        text = file.read().decode(encoding, errors='replace')
+    metadata = f"File: {os.path.relpath(filepath)}\nOriginal Path: {filepath}\nEncoding: {encoding.upper()}\n"
+    if start == width:
+        return metadata + f"File Size: {size} bytes\n\n" + text
+    newline = text.find('\n')
+    if 0 <= newline < len(text) - 1:
+        text = text[newline + 1:]
+    return metadata + f"{TRUNCATION_NOTE} to its last {len(text)} of about {(size - width) // width} characters.\n\n" + text
+
+def compile_ignore_pattern(pattern):
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # Like .gitignore: a pattern with no inner slash matches a name at any depth
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    prefix = '' if anchored else '(?:.*/)?'
+    return re.compile(prefix + regex + '$'), negate, dir_only
+
+
+class IgnoreRules:
+    def __init__(self, include=(), exclude=(), ignore_file=None):
+        patterns = list(DEFAULT_EXCLUDES)
+        if ignore_file:
+            with open(ignore_file, 'r', encoding='utf-8') as file:
+                patterns += [line.strip() for line in file if line.strip() and not line.startswith('#')]
+        patterns += list(exclude)
+        self.exclude = [compile_ignore_pattern(pattern) for pattern in patterns]
+        self.include = [compile_ignore_pattern(pattern) for pattern in include]
+
+    def excluded(self, relative_path, is_dir):
+        # The last matching rule wins, so later "!pattern" entries can re-include
+        result = False
+        for regex, negate, dir_only in self.exclude:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                result = not negate
+        if result or is_dir or not self.include:
+            return result
+        return not any(regex.match(relative_path) for regex, negate, dir_only in self.include)
+
+
+@dataclasses.dataclass
+class ScanOptions:
+    include: list = dataclasses.field(default_factory=list)
+    exclude: list = dataclasses.field(default_factory=list)
+    ignore_file: str = None
+    max_depth: int = None
+    max_file_size: int = None
+    symlinks: str = 'follow'  # 'skip', 'files' (follow file links only) or 'follow'
+    sniff: bool = True  # Skip binaries and non-UTF-8 text by looking at the first few KB of each file
+    workers: int = 8
+
+
+def scan_directory(directory, emit, options=None):
+    # Walks directories in parallel with os.scandir and hands files to emit() in
+    # per-directory batches as soon as they are found; returns counts of what was filtered out
+    options = options or ScanOptions()
+    rules = IgnoreRules(options.include, options.exclude, options.ignore_file)
+    stats = collections.Counter()
+    lock = threading.Lock()
+    done = threading.Event()
+    pending = [0]
+    followed = set()
+    executor = ThreadPoolExecutor(max_workers=options.workers)
+
+    def submit(path, depth):
+        with lock:
+            pending[0] += 1
+        executor.submit(scan, path, depth)
+
+    def scan(path, depth):
+        try:
+            files = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    relative_path = os.path.relpath(entry.path, directory).replace(os.sep, '/')
+                    try:
+                        is_link = entry.is_symlink()
+                        if is_link and options.symlinks == 'skip':
+                            stats['symlink'] += 1
+                        elif entry.is_dir(follow_symlinks=options.symlinks == 'follow'):
+                            if rules.excluded(relative_path, True):
+                                stats['excluded'] += 1
+                            elif options.max_depth is not None and depth >= options.max_depth:
+                                stats['too deep'] += 1
+                            elif is_link and not follow_link(entry.path, path):
+                                stats['symlink loop'] += 1
+                            else:
+                                submit(entry.path, depth + 1)
+                        elif entry.is_file():
+                            if rules.excluded(relative_path, False):
+                                stats['excluded'] += 1
+                            elif options.max_file_size is not None and entry.stat().st_size > options.max_file_size:
+                                stats['too large'] += 1
+                            elif options.sniff and (reason := sniff_file(entry.path)):
+                                stats[reason] += 1
+                            else:
+                                files.append(entry.path)
+                    except OSError:
+                        stats['unreadable'] += 1
+            stats['files'] += len(files)
+            if files:
+                emit(files)
+        except OSError as e:
+            print(f"Error scanning {path}: {str(e)}")
+            stats['unreadable'] += 1
+        finally:
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    done.set()
+
+    def follow_link(link_path, parent):
+        target = os.path.realpath(link_path)
+        with lock:
+            # A link into one of its own ancestors, or to a tree already followed, would loop or repeat
+            if target in followed or (os.path.realpath(parent) + os.sep).startswith(target + os.sep):
+                return False
+            followed.add(target)
+        return True
+
+    submit(directory, 0)
+    done.wait()
+    executor.shutdown()
+    emit(None)
+    return stats
+
+
+def read_tail(filepath, max_lines, block_size=TAIL_BLOCK_SIZE):
+    # Seek backwards from the end in blocks until enough line breaks have been seen,
+    # so the cost depends on the size of the tail rather than the size of the file
+    with open(filepath, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        blocks = []
+        newlines = 0
+        while position > 0 and newlines <= max_lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            file.seek(position)
+            block = file.read(read_size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+    data = b''.join(reversed(blocks))
+    trailing_newline = data.endswith(b'\n')
+    lines = (data[:-1] if trailing_newline else data).split(b'\n')[-max_lines:]
+    return b'\n'.join(lines) + (b'\n' if trailing_newline else b'')
+
+def read_tail_bytes(filepath, max_bytes, end=None):
+    with open(filepath, 'rb') as file:
+        size = file.seek(0, os.SEEK_END) if end is None else end
+        start = max(0, size - max_bytes)
+        file.seek(max(0, start - 1))
+        at_line_start = start == 0 or file.read(1) == b'\n'
+        data = file.read(min(max_bytes, size - start))
+    if not at_line_start:
+        # Start the window on a line boundary unless the whole window is one long line
+        newline = data.find(b'\n')
+        if 0 <= newline < len(data) - 1:
+            data = data[newline + 1:]
+    return data
+
+def read_range(filepath, start, end):
     with open(filepath, 'rb') as file:
-        lines = file.readlines()[-max_lines:]
+        file.seek(start)
+        return file.read(end - start)
+
+def line_segments(filepath, segment_bytes):
+    # Returns (first_line, last_line, start, end) per segment. Only segment boundaries are
+    # indexed, so memory stays flat however many lines the file has.
+    segments = []
+    with open(filepath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start, first_line = 0, 1
+        while start < len(data):
+            newline = data.rfind(b'\n', start, start + segment_bytes)
+            if newline == -1:
+                # A single line longer than a segment becomes a segment of its own
+                newline = data.find(b'\n', start + segment_bytes)
+            end = len(data) if newline == -1 else newline + 1
+            lines = data[start:end].count(b'\n') + (0 if data[end - 1:end] == b'\n' else 1)
+            segments.append((first_line, first_line + lines - 1, start, end))
+            start, first_line = end, first_line + lines
+    return segments
+
+def truncate_file(filepath, max_lines=100):
     with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix='.txt') as temp_file:
-        temp_file.writelines(lines)
+        temp_file.write(read_tail(filepath, max_lines))
     return temp_file.name
 
-def is_json(content):
+def parse_timestamp(text):
+    text = text.replace(',', '.').replace(' ', 'T', 1)
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    # fromisoformat only takes up to microseconds
+    text = re.sub(r'(\.\d{6})\d+', r'\1', text)
     try:
-        json.loads(content)
-        return True
-    except json.JSONDecodeError:
-        return False
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
 
-def upload_file_with_retry(filepath, display_name, mime_type, max_retries=5, base_wait_time=5, max_lines=75, max_size_no_truncate=104800, force_mime_type=None):
-    relative_path = os.path.relpath(filepath)
-    
+def normalize_log_text(text):
+    # Returns the denser text plus a description of the rewrites for the metadata header
+    original = text
+    text = ANSI_PATTERN.sub('', text.replace('\r\n', '\n').replace('\r', '\n'))
+    text = CONTROL_PATTERN.sub('', text)
+    text = '\n'.join(INNER_WHITESPACE_PATTERN.sub(' ', line.rstrip()) for line in text.split('\n'))
+
+    notes = ["ANSI/control codes stripped, whitespace collapsed"] if text != original else []
+    base = None
+    deltas = 0
+
+    def to_delta(match):
+        nonlocal base, deltas
+        parsed = parse_timestamp(match.group(0))
+        if parsed is None:
+            return match.group(0)
+        if base is None:
+            base = parsed
+            return match.group(0)
+        if (parsed.tzinfo is None) != (base.tzinfo is None):
+            return match.group(0)
+        deltas += 1
+        # As many decimals as the source had (fromisoformat keeps at most six), so no ordering is lost
+        fraction = re.search(r'[.,](\d+)', match.group(0))
+        decimals = min(len(fraction.group(1)), 6) if fraction else 0
+        return f"{(parsed - base).total_seconds():+.{decimals}f}s"
+
+    text = TIMESTAMP_PATTERN.sub(to_delta, text)
+    if deltas:
+        notes.append(f"timestamps after the first are shown as signed seconds (+12.5s, -3s) relative to {base.isoformat()}")
+
+    # Only IDs that repeat pay for their entry in the alias table
+    counts = collections.Counter(LONG_ID_PATTERN.findall(text))
+    aliases = {}
+    for identifier, count in counts.most_common():
+        if count < 2:
+            break
+        aliases[identifier] = f"<id{len(aliases) + 1}>"
+    if aliases:
+        text = LONG_ID_PATTERN.sub(lambda match: aliases.get(match.group(0), match.group(0)), text)
+        notes.append("ID aliases: " + ", ".join(f"{alias}={identifier}" for identifier, alias in aliases.items()))
+    return text, notes
+
+def normalize_content(full_content):
+    metadata, separator, body = full_content.partition('\n\n')
+    if not separator:
+        return full_content
+    body, notes = normalize_log_text(body)
+    if not notes:
+        return full_content
+    return metadata + "\n" + "".join(f"Normalized: {note}\n" for note in notes) + "\n" + body
+
+@dataclasses.dataclass
+class LogTemplate:
+    id: int
+    tokens: list
+    path: tuple
+    count: int = 0
+    first_seen: str = None
+    last_seen: str = None
+    samples: list = dataclasses.field(default_factory=list)
+    lines: list = dataclasses.field(default_factory=list)
+
+
+class LogTemplateMiner:
+    # Drain: lines are grouped by token count and leading tokens, and each line is only
+    # compared with the few templates in its group, so mining is a single streaming pass
+    WILDCARD = '<*>'
+
+    def __init__(self, depth=TEMPLATE_TREE_DEPTH, similarity=TEMPLATE_SIMILARITY, max_children=TEMPLATE_MAX_CHILDREN, max_clusters=TEMPLATE_MAX_CLUSTERS):
+        self.depth = depth
+        self.similarity = similarity
+        self.max_children = max_children
+        self.max_clusters = max_clusters
+        self.tree = {}
+        self.clusters = collections.OrderedDict()  # Least recently matched first
+        self.next_id = 0
+        self.lines = 0
+        self.evicted_clusters = 0
+        self.evicted_lines = 0
+
+    def add(self, line):
+        line = line.rstrip('\r\n')
+        match = TIMESTAMP_PATTERN.search(line)
+        timestamp = match.group(0) if match else None
+        # The timestamp goes into the template's time span rather than its parameters
+        tokens = (line[:match.start()] + line[match.end():] if match else line).split()
+        if not tokens:
+            return
+        self.lines += 1
+        path, leaf = self.leaf(tokens)
+        cluster = self.best_match(leaf, tokens)
+        if cluster is None:
+            cluster = LogTemplate(self.next_id, tokens, path)
+            self.next_id += 1
+            self.clusters[cluster.id] = cluster
+            leaf.append(cluster.id)
+            if len(self.clusters) > self.max_clusters:
+                self.evict()
+        else:
+            self.clusters.move_to_end(cluster.id)
+            merged = [token if token == other else self.WILDCARD for token, other in zip(cluster.tokens, tokens)]
+            if merged != cluster.tokens:
+                cluster.tokens = merged
+                cluster.samples = []
+        cluster.count += 1
+        if timestamp:
+            cluster.first_seen = cluster.first_seen or timestamp
+            cluster.last_seen = timestamp
+        if cluster.lines is not None:
+            cluster.lines.append(line)
+            if cluster.count > TEMPLATE_RARE_COUNT:
+                cluster.lines = None
+        params = tuple(other for token, other in zip(cluster.tokens, tokens) if token == self.WILDCARD)
+        if params and len(cluster.samples) < TEMPLATE_SAMPLES and params not in cluster.samples:
+            cluster.samples.append(params)
+
+    def leaf(self, tokens):
+        path = [len(tokens)]
+        node = self.tree.setdefault(len(tokens), {})
+        prefix = tokens[:self.depth - 2]
+        for i, token in enumerate(prefix):
+            key = self.WILDCARD if DIGIT_PATTERN.search(token) else token
+            if key not in node and len(node) >= self.max_children:
+                key = self.WILDCARD
+            path.append(key)
+            node = node.setdefault(key, [] if i == len(prefix) - 1 else {})
+        return tuple(path), node
+
+    def best_match(self, leaf, tokens):
+        best, best_score = None, None
+        for cluster_id in leaf:
+            cluster = self.clusters[cluster_id]
+            same = wildcards = 0
+            for token, other in zip(cluster.tokens, tokens):
+                if token == self.WILDCARD:
+                    wildcards += 1
+                elif token == other:
+                    same += 1
+            score = (same / len(tokens), wildcards)
+            if best_score is None or score > best_score:
+                best, best_score = cluster, score
+        return best if best_score and best_score[0] >= self.similarity else None
+
+    def evict(self):
+        _, cluster = self.clusters.popitem(last=False)
+        self.evicted_clusters += 1
+        self.evicted_lines += cluster.count
+        # Prune the branch if this was the last template in it
+        nodes = [self.tree]
+        for key in cluster.path[:-1]:
+            nodes.append(nodes[-1][key])
+        leaf = nodes[-1][cluster.path[-1]]
+        leaf.remove(cluster.id)
+        child_empty = not leaf
+        for node, key in zip(reversed(nodes), reversed(cluster.path)):
+            if not child_empty:
+                break
+            del node[key]
+            child_empty = not node
+
+    def render(self):
+        output = []
+        for cluster in sorted(self.clusters.values(), key=lambda cluster: cluster.id):
+            if cluster.lines is not None:
+                output.extend(cluster.lines)
+                continue
+            span = f" [{cluster.first_seen} .. {cluster.last_seen}]" if cluster.first_seen else ""
+            examples = "; ".join(" ".join(params) for params in cluster.samples)
+            output.append(f"{cluster.count}x{span} {' '.join(cluster.tokens)}" + (f"  (e.g. {examples})" if examples else ""))
+        return "\n".join(output) + "\n"
+
+def mine_log_templates(filepath):
+    miner = LogTemplateMiner()
     with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
-        content = file.read()
-    
-    file_size = len(content)
-    is_json_file = is_json(content)
+        while line := file.readline(TEMPLATE_MAX_LINE_CHARS):
+            if not line.endswith('\n'):
+                # Skip the rest of an overlong line without holding it in memory
+                while (rest := file.readline(TEMPLATE_MAX_LINE_CHARS)) and not rest.endswith('\n'):
+                    pass
+            miner.add(line)
+    return miner
+
+def template_summary(filepath):
+    miner = mine_log_templates(filepath)
+    note = (f"{TRUNCATION_NOTE} to {len(miner.clusters)} line templates summarizing all {miner.lines} lines. "
+            f"Each template shows its count, first and last timestamp, and example values for {LogTemplateMiner.WILDCARD}; "
+            f"templates seen {TEMPLATE_RARE_COUNT} times or less are shown as the original lines.\n")
+    if miner.evicted_lines:
+        note += f"{miner.evicted_lines} lines from {miner.evicted_clusters} infrequent templates were dropped.\n"
+    return note + "\n" + miner.render()
+
+@dataclasses.dataclass
+class ExcerptOptions:
+    patterns: list = dataclasses.field(default_factory=lambda: list(EXCERPT_DEFAULT_PATTERNS))
+    context: int = 5
+    max_tokens: int = 8000
+
+    def __post_init__(self):
+        self.compiled = re.compile('|'.join(f'(?:{pattern})' for pattern in self.patterns))
+
+    def max_chars(self):
+        # Sized for the worst-case rate of an uncalibrated file type, so the excerpt stays under the cap
+        return int(self.max_tokens / (ESTIMATOR_DEFAULT_RATIO * (1 + ESTIMATOR_DEFAULT_ERROR)))
+
+def fit_lines(lines, max_chars):
+    # The leading lines that fit; a first line longer than max_chars is cut short rather than dropped
+    fitted, used = [], 0
+    for line in lines:
+        if fitted and used + len(line) + 1 > max_chars:
+            break
+        fitted.append(line[:max(1, int(max_chars - used - 1))])
+        used += len(fitted[-1]) + 1
+    return fitted
+
+def excerpt_file(filepath, options, max_chars):
+    # One pass keeps the head, a rolling tail, and windows of context around matching lines.
+    # The earliest windows (often the root cause) and the latest ones (the final state) each
+    # get half of the window budget; windows in between are dropped once the budget is spent.
+    # The head and the tail get whatever the windows leave, and give up lines when those are long.
+    window_budget = max_chars * 0.8 / 2
+    head, tail = [], collections.deque(maxlen=EXCERPT_TAIL_LINES)
+    before = collections.deque(maxlen=options.context)
+    early, late = [], collections.deque()
+    early_chars = late_chars = 0
+    window, window_chars, emit_until = None, 0, 0
+    matches = omitted = 0
+
+    def close(window, chars):
+        nonlocal early_chars, late_chars, omitted
+        if early_chars + chars <= window_budget:
+            early.append(window)
+            early_chars += chars
+            return
+        late.append((window, chars))
+        late_chars += chars
+        while late_chars > window_budget and len(late) > 1:
+            late_chars -= late.popleft()[1]
+            omitted += 1
+
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
+        for number, line in enumerate(file, 1):
+            line = line.rstrip('\r\n')[:EXCERPT_MAX_LINE_CHARS]
+            if number <= EXCERPT_HEAD_LINES:
+                head.append(line)
+            tail.append(line)
+            if options.compiled.search(line):
+                matches += 1
+                if window is None:
+                    window = (number - len(before), list(before))
+                    window_chars = sum(len(previous) + 1 for previous in before)
+                emit_until = number + options.context
+            if window is not None:
+                window[1].append(line)
+                window_chars += len(line) + 1
+                if number >= emit_until or window_chars > window_budget / 4:
+                    close(window, window_chars)
+                    window = None
+            before.append(line)
+        last_line = number if head else 0
+    if window is not None:
+        close(window, window_chars)
+
+    windows = early + [window for window, chars in late]
+    room = max(0, max_chars * 0.9 - sum(len(line) + 1 for first, lines in windows for line in lines))
+    head = fit_lines(head, room / 2)
+    tail = fit_lines(list(tail)[::-1], room - sum(len(line) + 1 for line in head))[::-1]
+    pieces = [(1, head)] + windows + [(last_line - len(tail) + 1, list(tail))]
+    # Merge overlapping and adjacent ranges so no line is shown twice
+    blocks = []
+    for first, lines in sorted(pieces, key=lambda piece: piece[0]):
+        if blocks and first <= blocks[-1][0] + len(blocks[-1][1]):
+            overlap = blocks[-1][0] + len(blocks[-1][1]) - first
+            blocks[-1][1].extend(lines[overlap:])
+        elif lines:
+            blocks.append((first, list(lines)))
+    body = []
+    for first, lines in blocks:
+        body.append(f"[lines {first}-{first + len(lines) - 1}]")
+        body.extend(lines)
+    note = (f"{TRUNCATION_NOTE} to an excerpt of its {last_line} lines: the first {len(head)}, the last {len(tail)}, "
+            f"and {matches} lines matching error patterns with {options.context} lines of context.\n")
+    if omitted:
+        note += f"{omitted} windows between the earliest and latest matches were left out to fit the token cap.\n"
+    return note + "\n" + "\n".join(body) + "\n"
+
+@dataclasses.dataclass
+class GrepOptions:
+    pattern: str
+    context: int = 0
+
+    def __post_init__(self):
+        re.compile(self.pattern)  # Fail on a bad pattern before the scan starts
+        self.pool = None
+
+    def executor(self):
+        # The regex engine holds the GIL, so matching runs in worker processes to use every core
+        if self.pool is None:
+            # Not forked: the scanner threads, thread pools and SQLite connections may hold locks at that moment.
+            # Windows has no forkserver, only spawn.
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def count_newlines(data, start, end):
+    # In blocks: one slice of the gap between distant matches would copy all of it out of the mmap
+    return sum(data[offset:min(end, offset + LINE_COUNT_BLOCK_SIZE)].count(b'\n') for offset in range(start, end, LINE_COUNT_BLOCK_SIZE))
+
+def grep_file(filepath, pattern, context, max_chars, range_start=0, range_end=None):
+    # Returns (body, matches, windows, omitted), or None when nothing matches
+    regex = re.compile(pattern.encode('utf-8'), re.MULTILINE)
+    blocks, chars, matches, omitted = [], 0, 0, 0
+    with open(filepath, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            line, counted = 1, 0
+            window = None
+
+            def flush(start, end):
+                nonlocal line, counted, chars, omitted
+                line += count_newlines(data, counted, start)
+                counted = start
+                if chars + end - start > max_chars:
+                    omitted += 1
+                    return
+                text = data[start:end].decode('utf-8', errors='replace').rstrip('\n')
+                blocks.append(f"[lines {line}-{line + text.count(chr(10))}]\n{text}")
+                chars += end - start
+
+            range_end = len(data) if range_end is None else range_end
+            for match in regex.finditer(data, range_start, range_end):
+                matches += 1
+                start = data.rfind(b'\n', range_start, match.start()) + 1
+                for _ in range(context):
+                    if start <= range_start:
+                        break
+                    start = data.rfind(b'\n', range_start, start - 1) + 1
+                start = max(start, range_start)
+                end = data.find(b'\n', max(match.start(), match.end() - 1), range_end)
+                for _ in range(context):
+                    if end == -1:
+                        break
+                    end = data.find(b'\n', end + 1, range_end)
+                end = range_end if end == -1 else end + 1
+                if window and start <= window[1]:
+                    window = (window[0], max(window[1], end))
+                    continue
+                if window:
+                    flush(*window)
+                window = (start, end)
+            if window:
+                flush(*window)
+    if not matches:
+        return None
+    return "\n".join(blocks) + "\n", matches, len(blocks) + omitted, omitted
+
+@dataclasses.dataclass
+class TimeWindow:
+    since: datetime.datetime = None
+    until: datetime.datetime = None
+
+    def bounds(self, aware):
+        # Naive bounds are taken as UTC against logs with time zones; time zones are dropped against naive logs
+        return [bound if bound is None or (bound.tzinfo is not None) == aware
+                else bound.replace(tzinfo=datetime.timezone.utc if aware else None)
+                for bound in (self.since, self.until)]
+
+def detect_line_time(filepath):
+    # Returns a function giving the timestamp at the start of a line (bytes), using
+    # whichever known format matches most lines in a sample from the start of the file
+    year = datetime.datetime.fromtimestamp(os.stat(filepath).st_mtime).year
+    formats = [
+        (TIMESTAMP_PATTERN, lambda text: parse_timestamp(text)),
+        (re.compile(r'\[(\d{2}/[A-Z][a-z]{2}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4})\]'),
+         lambda text: datetime.datetime.strptime(text, '%d/%b/%Y:%H:%M:%S %z')),
+        (re.compile(r'^([A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2})\b'),
+         lambda text: datetime.datetime.strptime(f"{year} {text}", '%Y %b %d %H:%M:%S')),
+        (re.compile(r'^(\d{10}(?:\.\d+)?)\b'),
+         lambda text: datetime.datetime.fromtimestamp(float(text), datetime.timezone.utc)),
+    ]
+    with open(filepath, 'rb') as file:
+        sample = file.read(TIME_SAMPLE_BYTES).decode('utf-8', errors='replace').splitlines()
+
+    def line_time_for(pattern, parse):
+        def line_time(line):
+            if isinstance(line, bytes):
+                line = line[:200].decode('utf-8', errors='replace')
+            match = pattern.search(line[:200])
+            if not match:
+                return None
+            try:
+                return parse(match.group(1) if pattern.groups else match.group(0))
+            except ValueError:
+                return None
+        return line_time
+
+    candidates = [line_time_for(pattern, parse) for pattern, parse in formats]
+    hits = [sum(candidate(line) is not None for line in sample) for candidate in candidates]
+    best = max(range(len(candidates)), key=lambda i: hits[i])
+    return candidates[best] if hits[best] else None
+
+def naive_time(timestamp):
+    # Times with a time zone are compared in UTC, the others in wall-clock time
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None) if timestamp.tzinfo else timestamp
+
+def time_window_range(filepath, window):
+    # Returns the (start, end) byte range of the lines inside the window, found by binary
+    # search over byte offsets on the assumption that the file is mostly time-ordered,
+    # or None when the file has no recognisable timestamps
+    line_time = detect_line_time(filepath)
+    if line_time is None:
+        return None
+    with open(filepath, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+
+        def probe(offset):
+            # The first timestamp on a line starting at or after offset, and where that line starts
+            file.seek(offset)
+            if offset:
+                file.readline()
+            for _ in range(TIME_SEARCH_MAX_LINES):
+                position = file.tell()
+                line = file.readline()
+                if not line:
+                    return None, size
+                timestamp = line_time(line)
+                if timestamp is not None:
+                    return timestamp, position
+            return None, file.tell()
+
+        first = probe(0)[0]
+        since, until = [None if bound is None else naive_time(bound) for bound in window.bounds(first is not None and first.tzinfo is not None)]
+
+        def lower_bound(reached):
+            low, high = 0, size
+            while low < high:
+                middle = (low + high) // 2
+                timestamp, position = probe(middle)
+                # A file may mix stamps with and without a time zone, which cannot be compared as they are
+                if timestamp is None or reached(naive_time(timestamp)):
+                    high = middle
+                else:
+                    low = middle + 1
+            return probe(low)[1] if low < size else size
+
+        start = 0 if since is None else lower_bound(lambda timestamp: timestamp >= since)
+        end = size if until is None else lower_bound(lambda timestamp: timestamp > until)
+    return start, max(start, end)
+
+def prepare_file_content(filepath, max_lines=DEFAULT_TAIL_LINES, max_size_no_truncate=MAX_UNTRUNCATED_BYTES, tail_bytes=None, normalize=False, templates=False, segment=None, excerpt=None):
+    if normalize:
+        return normalize_content(prepare_file_content(filepath, max_lines, max_size_no_truncate, tail_bytes, templates=templates, segment=segment, excerpt=excerpt))
+    relative_path = os.path.relpath(filepath)
+    file_size = os.stat(filepath).st_size
     
     metadata = f"File: {relative_path}\nOriginal Path: {filepath}\n"
+
+    if segment is not None:
+        first_line, last_line, start, end = segment
+        metadata = f"File: {relative_path} [lines {first_line}-{last_line}]\nOriginal Path: {filepath}\n"
+        if tail_bytes is not None and end - start > tail_bytes:
+            window = read_tail_bytes(filepath, tail_bytes, end=end)
+            return metadata + f"{TRUNCATION_NOTE} to the last {len(window)} of the {end - start} bytes in this segment.\n\n" + window.decode('utf-8', errors='replace')
+        return metadata + f"Segment: bytes {start}-{end} of {file_size}\n\n" + read_range(filepath, start, end).decode('utf-8', errors='replace')
+
+    if excerpt is not None and file_size > (max_size_no_truncate if tail_bytes is None else tail_bytes):
+        return metadata + excerpt_file(filepath, excerpt, excerpt.max_chars() if tail_bytes is None else min(excerpt.max_chars(), tail_bytes))
     
+    if tail_bytes is not None:
+        max_size_no_truncate = tail_bytes
+        if file_size > tail_bytes:
+            window = read_tail_bytes(filepath, tail_bytes)
+            return metadata + f"{TRUNCATION_NOTE} to its last {len(window)} of {file_size} bytes.\n\n" + window.decode('utf-8', errors='replace')
+    elif templates and file_size > max_size_no_truncate:
+        return metadata + template_summary(filepath)
     if file_size <= max_size_no_truncate:
-        full_content = metadata + f"File Size: {file_size} bytes\n\n" + content
-    else:
-        lines = content.split('\n')
-        truncated_content = '\n'.join(lines[-max_lines:])
-        full_content = metadata + f"Note: This file has been truncated to the last {max_lines} lines.\n\n" + truncated_content
-    
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as temp_file:
-        temp_file.write(full_content)
-        temp_file_path = temp_file.name
+        with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
+            content = file.read()
+        return metadata + f"File Size: {file_size} bytes\n\n" + content
+    truncated_content = read_tail(filepath, max_lines).decode('utf-8', errors='replace')
+    return metadata + f"{TRUNCATION_NOTE} to the last {max_lines} lines.\n\n" + truncated_content
 
-    file_size = os.path.getsize(temp_file_path)
+def upload_file_with_retry(filepath, display_name, mime_type, max_retries=5, base_wait_time=5, max_lines=DEFAULT_TAIL_LINES, max_size_no_truncate=MAX_UNTRUNCATED_BYTES, force_mime_type=None, full_content=None, observer=None, normalize=False):
+    relative_path = os.path.relpath(filepath)
+    
+    if full_content is None:
+        full_content = prepare_file_content(filepath, max_lines=max_lines, max_size_no_truncate=max_size_no_truncate, normalize=normalize)
     
+    # Upload straight from memory: no temp file to write, read back, or leak if we're killed mid-retry
+    payload = full_content.encode('utf-8', errors='replace')
+    file_size = len(payload)
+    is_truncated = TRUNCATION_NOTE in full_content[:4096]
+    
+    wait_time = base_wait_time
     for attempt in range(max_retries):
+        retry_policy.before_attempt()
+        start_time = time.time()
         try:
-            print(f"Attempting to upload {relative_path} {'(truncated)' if file_size > max_size_no_truncate and not is_json_file else ''} (Size: {file_size/1024/1024:.2f}MB)")
-            start_time = time.time()
-            file_response = genai.upload_file(path=temp_file_path, display_name=display_name, mime_type=force_mime_type or mime_type)
+            print(f"Attempting to upload {relative_path} {'(truncated)' if is_truncated else ''} (Size: {file_size/1024/1024:.2f}MB)")
+            rate_limiter.acquire(bytes=file_size)
+            file_response = genai.upload_file(path=io.BytesIO(payload), display_name=display_name, mime_type=force_mime_type or mime_type)
             upload_time = time.time() - start_time
+            retry_policy.record_success()
+            if observer:
+                observer(upload_time)
             print(f"Successfully uploaded {relative_path} in {upload_time:.2f} seconds")
-            os.unlink(temp_file_path)
             file_response.text = full_content
             return file_response
         except Exception as e:
+            if observer:
+                observer(time.time() - start_time, e)
             print(f"Error uploading {relative_path}: {str(e)}")
-            if attempt < max_retries - 1:
-                wait_time = base_wait_time * (2 ** attempt)
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                os.unlink(temp_file_path)
+            wait_time = retry_policy.next_wait(e, attempt, max_retries, wait_time, base_wait_time)
+            if wait_time is None:
                 raise
-def count_tokens_with_retry(model, file_response, max_retries=5, base_wait_time=5):
+            print(f"Retrying in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+def count_tokens_with_retry(model, contents, description, max_retries=5, base_wait_time=5, observer=None):
+    wait_time = base_wait_time
     for attempt in range(max_retries):
+        retry_policy.before_attempt()
+        start_time = time.time()
         try:
-            print(f"Counting tokens for {file_response.display_name}")
-            token_count = model.count_tokens([file_response])
-            print(f"Token count for {file_response.display_name}: {token_count.total_tokens}")
+            print(f"Counting tokens for {description}")
+            rate_limiter.acquire()
+            token_count = model.count_tokens(contents)
+            retry_policy.record_success()
+            if observer:
+                observer(time.time() - start_time)
+            print(f"Token count for {description}: {token_count.total_tokens}")
             return token_count.total_tokens
         except Exception as e:
+            if observer:
+                observer(time.time() - start_time, e)
             print(f"Error counting tokens: {str(e)}")
-            if attempt < max_retries - 1:
-                wait_time = base_wait_time * (2 ** attempt)
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
+            wait_time = retry_policy.next_wait(e, attempt, max_retries, wait_time, base_wait_time)
+            if wait_time is None:
                 raise
+            print(f"Retrying in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+
+class Summarizer:
+    def __init__(self, model_name, cache_dir=None, concurrency=4, max_input_tokens=1000000):
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name=model_name)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.max_input_tokens = max_input_tokens
+        self.lock = threading.Lock()
+        self.spent_tokens = 0
+        self.stats = collections.Counter()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, 'manifest.sqlite3')
+        else:
+            self.path = ':memory:'
+        # Called from worker threads, so one connection is shared under the lock
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL, created REAL NOT NULL)")
+        self.conn.commit()
+
+    def summarize(self, filepath, segment=None, max_retries=5, base_wait_time=5):
+        # Returns the summary, or None when the cost cap leaves no room for this file
+        if segment:
+            data = read_range(filepath, segment[2], min(segment[3], segment[2] + SUMMARY_MAX_INPUT_BYTES))
+        else:
+            data = read_tail_bytes(filepath, SUMMARY_MAX_INPUT_BYTES)
+        key = f"{hashlib.sha256(data).hexdigest()}:{self.model_name}:{hashlib.sha256(SUMMARY_PROMPT.encode()).hexdigest()[:8]}"
+        with self.lock:
+            row = self.conn.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.stats['cached'] += 1
+                return row[0]
+            estimated_tokens = math.ceil(len(data) * ESTIMATOR_DEFAULT_RATIO * (1 + ESTIMATOR_DEFAULT_ERROR))
+            if self.spent_tokens + estimated_tokens > self.max_input_tokens:
+                self.stats['capped'] += 1
+                return None
+            self.spent_tokens += estimated_tokens
+
+        text = data.decode('utf-8', errors='replace')
+        wait_time = base_wait_time
+        with self.slots:
+            for attempt in range(max_retries):
+                retry_policy.before_attempt()
+                try:
+                    print(f"Summarizing {os.path.relpath(filepath)} with {self.model_name}")
+                    rate_limiter.acquire(tokens=estimated_tokens)
+                    response = self.model.generate_content([SUMMARY_PROMPT, text], generation_config={'max_output_tokens': SUMMARY_MAX_OUTPUT_TOKENS})
+                    summary = response.text
+                    retry_policy.record_success()
+                    break
+                except Exception as e:
+                    print(f"Error summarizing {os.path.relpath(filepath)}: {str(e)}")
+                    wait_time = retry_policy.next_wait(e, attempt, max_retries, wait_time, base_wait_time)
+                    if wait_time is None:
+                        raise
+                    print(f"Retrying in {wait_time:.1f} seconds...")
+                    time.sleep(wait_time)
+        with self.lock:
+            self.stats['summarized'] += 1
+            self.conn.execute("INSERT OR REPLACE INTO summaries (key, summary, created) VALUES (?, ?, ?)", (key, summary, time.time()))
+            self.conn.commit()
+        return summary
+
+    def report(self):
+        if self.stats:
+            print(f"Summaries from {self.model_name}: {self.stats['summarized']} new (~{self.spent_tokens} input tokens), "
+                  f"{self.stats['cached']} cached, {self.stats['capped']} left as they were by the input token cap")
+
+    def close(self):
+        self.conn.close()
+
+
+@dataclasses.dataclass
+class PlannedFile:
+    filepath: str
+    relative_path: str
+    mime_type: str
+    content: str = None
+    key: str = None
+    tokens: int = None
+    cached_name: str = None
+    estimated: bool = False
+    lower: int = None
+    upper: int = None
+    mtime: float = None
+    score: float = 1.0
+    size: int = None
+    truncated: bool = False
+    raw_chars: int = None
+    digest: str = None
+    aliases: list = dataclasses.field(default_factory=list)
+    alias_tokens: int = 0
+    segment: tuple = None  # (first_line, last_line, start, end) when this is one part of a chunked file
+    display_name: str = None
+    filtered: bool = False  # Readable, but nothing in it passed the content filters
+    sources: list = None  # Paths merged into this document, for timeline documents
+    capped: bool = False  # Sized to the per-file token cap
+    excerpted: bool = False  # Shown as an excerpt, which is already as large as it gets
+    near_duplicate: tuple = None  # (representative, its content, this file's content) while uploaded as a diff against it
+
+    def __post_init__(self):
+        if self.display_name is None:
+            self.display_name = self.relative_path
+
+def count_tokens_batch(model, batch, observer=None):
+    total = count_tokens_with_retry(model, [planned.content for planned in batch], f"{len(batch)} files", observer=observer)
+    if len(batch) == 1:
+        batch[0].tokens = total
+        return
+    # count_tokens only reports a total per request, so split it by each file's share of the text
+    total_chars = sum(len(planned.content) for planned in batch) or 1
+    for planned in batch:
+        planned.tokens = max(1, round(total * len(planned.content) / total_chars))
+
+def batch_for_counting(planned_files):
+    batch, batch_chars = [], 0
+    for planned in planned_files:
+        if batch and (len(batch) >= COUNT_BATCH_MAX_FILES or batch_chars + len(planned.content) > COUNT_BATCH_MAX_CHARS):
+            yield batch
+            batch, batch_chars = [], 0
+        batch.append(planned)
+        batch_chars += len(planned.content)
+    if batch:
+        yield batch
+
+async def prepare_planned_file(planned, force_mime_type, manifest, content_options, tail_bytes=None):
+    try:
+        stat = os.stat(planned.filepath)
+        planned.mtime, planned.size = stat.st_mtime, stat.st_size
+        planned.excerpted = False
+        start, end = planned.segment[2:] if planned.segment else (0, None)
+        encoding = await asyncio.to_thread(bom_encoding, planned.filepath)
+        wide = encoding not in (None, 'utf-8')
+        in_window = None
+        if content_options.time_window and not (planned.segment or wide):
+            in_window = await asyncio.to_thread(time_window_range, planned.filepath, content_options.time_window)
+            if in_window is not None:
+                start, end = in_window
+                if start == end:
+                    planned.filtered = True
+                    planned.content = None
+                    return planned
+        if planned.segment or in_window:
+            planned.size = end - start
+        if wide:
+            if tail_bytes is None:
+                planned.digest = await asyncio.to_thread(file_digest, planned.filepath)
+            planned.content = await asyncio.to_thread(prepare_wide_text, planned.filepath, encoding, tail_bytes)
+        elif content_options.grep:
+            grep = content_options.grep
+            found = await asyncio.get_running_loop().run_in_executor(grep.executor(), grep_file, planned.filepath, grep.pattern, grep.context, tail_bytes or GREP_MAX_CHARS, start, end)
+            if found is None:
+                planned.filtered = True
+                planned.content = None
+                return planned
+            body, matches, windows, omitted = found
+            note = f"{TRUNCATION_NOTE} to {windows} windows around {matches} matches of {grep.pattern!r} with {grep.context} lines of context.\n"
+            if omitted:
+                note += f"{omitted} of the windows were left out to fit the token budget.\n"
+            planned.digest = hashlib.sha256(body.encode('utf-8', errors='replace')).hexdigest()
+            planned.content = f"File: {os.path.relpath(planned.filepath)}\nOriginal Path: {planned.filepath}\n" + note + "\n" + body
+        elif in_window:
+            if tail_bytes is None:
+                planned.digest = await asyncio.to_thread(file_digest, planned.filepath, start, end)
+            window = await asyncio.to_thread(read_tail_bytes, planned.filepath, min(end - start, tail_bytes or MAX_UNTRUNCATED_BYTES), end)
+            note = f"Time Window: bytes {start}-{end} of {stat.st_size}, the lines between {content_options.time_window.since or 'the start'} and {content_options.time_window.until or 'the end'}\n"
+            if len(window) < end - start:
+                note += f"{TRUNCATION_NOTE} to the last {len(window)} bytes of the window.\n"
+            planned.content = f"File: {os.path.relpath(planned.filepath)}\nOriginal Path: {planned.filepath}\n" + note + "\n" + window.decode('utf-8', errors='replace')
+        else:
+            if tail_bytes is None:
+                planned.digest = await asyncio.to_thread(file_digest, planned.filepath, start, end)
+            planned.content = await asyncio.to_thread(prepare_file_content, planned.filepath, tail_bytes=tail_bytes, templates=content_options.templates, segment=planned.segment, excerpt=content_options.excerpt)
+            planned.excerpted = bool(content_options.excerpt and not planned.segment and stat.st_size > (tail_bytes or MAX_UNTRUNCATED_BYTES))
+        if content_options.normalize:
+            planned.raw_chars = len(planned.content)
+            planned.content = await asyncio.to_thread(normalize_content, planned.content)
+    except BrokenProcessPool:
+        # Every later file would fail the same way and be skipped as unreadable
+        raise
+    except Exception as e:
+        print(f"Error reading {planned.filepath}: {str(e)}")
+        planned.content = None
+        return planned
+    if tail_bytes is not None:
+        planned.truncated = planned.size > tail_bytes
+    else:
+        # Segments, template summaries and grep matches already cover their whole range, so they are sized like any untruncated file
+        planned.truncated = planned.size > MAX_UNTRUNCATED_BYTES and (wide or not (planned.segment or content_options.templates or content_options.grep))
+    rekey(planned, manifest, force_mime_type)
+    return planned
+
+def rekey(planned, manifest, force_mime_type):
+    # New content: the old count and upload no longer apply, but an earlier run may have sent the same text
+    planned.tokens = planned.cached_name = None
+    if manifest:
+        planned.key = manifest_key(planned.content, force_mime_type or planned.mime_type)
+        cached = manifest.lookup(planned.key)
+        if cached:
+            planned.cached_name, planned.tokens, upper = cached
+            planned.estimated = upper is not None
+            if planned.estimated:
+                planned.lower, planned.upper = 2 * planned.tokens - upper, upper
+
+async def count_planned_batch(model, batch, concurrency, estimator=None):
+    async with concurrency:
+        try:
+            await asyncio.to_thread(count_tokens_batch, model, batch, concurrency.observer('count_tokens'))
+        except Exception as e:
+            print(f"Error counting tokens for {len(batch)} files: {str(e)}")
+            return
+    for planned in batch:
+        planned.estimated = False
+    if estimator and len(batch) == 1:
+        estimator.add_sample(TokenEstimator.file_type(batch[0].filepath, batch[0].mime_type), len(batch[0].content), batch[0].tokens)
+
+def calibration_samples(planned_files, estimator):
+    sampled = {}
+    for planned in planned_files:
+        file_type = TokenEstimator.file_type(planned.filepath, planned.mime_type)
+        if estimator.is_calibrated(file_type):
+            continue
+        if sampled.setdefault(file_type, 0) < ESTIMATOR_MIN_SAMPLES:
+            sampled[file_type] += 1
+            yield planned
+
+@dataclasses.dataclass
+class ContentOptions:
+    normalize: bool = False
+    templates: bool = False  # Summarize oversized files as log templates instead of keeping only their tail
+    near_duplicates: bool = False  # Upload only what differs from a representative for files that are almost the same
+    chunk_bytes: int = None  # Split larger files into line-aligned segments the allocator chooses between
+    excerpt: ExcerptOptions = None  # Show oversized files as error-focused excerpts instead of their tail
+    grep: GrepOptions = None  # Upload only the lines around matches of a pattern, from every file
+    time_window: TimeWindow = None  # Upload only the lines of time-stamped files that fall inside the window
+    timeline: bool = False  # Merge the selected time-stamped files into a few time-ordered documents
+    summarizer: Summarizer = None  # Replace oversized files and segments with a summary from a cheaper model
+    token_cap: int = None  # Tokens each file may use; truncated files get the largest window that fits
+
+    def __post_init__(self):
+        if self.timeline and self.normalize:
+            # Normalized files keep only their first timestamp and number their ID aliases per file
+            raise ValueError("timeline and normalize can't be combined")
+
 
-def process_file(args):
-    filepath, relative_path, mime_type, force_mime_type, model_name, api_key = args
+@dataclasses.dataclass
+class ScoringOptions:
+    priority: list = dataclasses.field(default_factory=list)  # (pattern, weight) pairs
+    type_weights: dict = dataclasses.field(default_factory=dict)
+    recency_weight: float = 1.0
+    error_weight: float = 1.0
+
+    def __post_init__(self):
+        self.compiled_priority = [(compile_ignore_pattern(pattern)[0], weight) for pattern, weight in self.priority]
+
+
+def parse_weights(values):
+    weights = []
+    for value in values:
+        key, _, weight = value.rpartition('=')
+        if not key:
+            raise ValueError(f"Expected PATTERN=WEIGHT, got {value!r}")
+        weights.append((key, float(weight)))
+    return weights
+
+def score_file(planned, scoring, now=None):
+    # Value per token: files that are recent, prioritised, error-dense or of a favoured type rank first
+    score = scoring.type_weights.get(TokenEstimator.file_type(planned.filepath, planned.mime_type), 1.0)
+    for regex, weight in scoring.compiled_priority:
+        if regex.match(planned.relative_path.replace(os.sep, '/')):
+            score *= weight
+    if planned.mtime is not None:
+        age = max(0.0, (now or time.time()) - planned.mtime)
+        score *= 1 + scoring.recency_weight * 0.5 ** (age / RECENCY_HALF_LIFE)
+    if planned.content:
+        lines = planned.content.count('\n') + 1
+        errors = len(ERROR_LINE_PATTERN.findall(planned.content))
+        score *= 1 + scoring.error_weight * min(1.0, 10 * errors / lines)
+    return score
+
+def masked_lines(full_content, pattern):
+    body = full_content.partition('\n\n')[2]
+    return [(line, pattern.sub('0', line).strip()) for line in body.split('\n') if line.strip()]
+
+def near_duplicate_clusters(planned_files):
+    # MinHash signatures of each file's line set, bucketed by LSH band, so a file is only
+    # compared with the files it shares a band with instead of with the whole corpus
+    rng = random.Random(0)
+    coefficients = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(NEAR_DUPLICATE_PERMUTATIONS)]
+    rows = NEAR_DUPLICATE_PERMUTATIONS // NEAR_DUPLICATE_BANDS
+    parent = list(range(len(planned_files)))
+    signatures = []
+    buckets = {}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, planned in enumerate(planned_files):
+        # Numbers (timestamps, PIDs, counters) differ between otherwise identical nodes
+        # A keyed hash rather than hash(), which is salted per process and would change the clusters between runs
+        shingles = {int.from_bytes(hashlib.blake2b(masked.encode('utf-8', errors='replace'), digest_size=8).digest(), 'big') & MERSENNE_PRIME
+                    for line, masked in masked_lines(planned.content, DIGIT_PATTERN)}
+        if not shingles:
+            signatures.append(None)
+            continue
+        signature = [min((a * shingle + b) % MERSENNE_PRIME for shingle in shingles) for a, b in coefficients]
+        signatures.append(signature)
+        for band in range(NEAR_DUPLICATE_BANDS):
+            j = buckets.setdefault((band, tuple(signature[band * rows:(band + 1) * rows])), i)
+            if j != i and sum(x == y for x, y in zip(signature, signatures[j])) >= NEAR_DUPLICATE_THRESHOLD * len(signature):
+                parent[find(i)] = find(j)
+
+    clusters = collections.defaultdict(list)
+    for i, planned in enumerate(planned_files):
+        if signatures[i] is not None:
+            clusters[find(i)].append(planned)
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+def near_duplicate_content(planned, representative, reference):
+    metadata = planned.content.partition('\n\n')[0]
+    # Masked like the clustering, so the lines that made the files similar are the ones left out
+    lines = masked_lines(planned.content, DIGIT_PATTERN)
+    unique = [line for line, masked in lines if masked not in reference]
+    return (metadata + f"\nNear-duplicate of: {representative.display_name} "
+            f"({len(lines) - len(unique)} of {len(lines)} lines match it apart from numbers and are left out)\n\n" + "\n".join(unique) + "\n")
+
+def knapsack(items, capacity):
+    # items are (weight, value) pairs; returns the indices of a value-maximising subset.
+    # Weights are rounded up to capacity / KNAPSACK_RESOLUTION steps, so the result always fits.
+    if sum(weight for weight, value in items) <= capacity:
+        return list(range(len(items)))
+    if len(items) > KNAPSACK_MAX_ITEMS:
+        order = sorted(range(len(items)), key=lambda i: items[i][1] / max(1, items[i][0]), reverse=True)
+        chosen, used = [], 0
+        for i in order:
+            if used + items[i][0] <= capacity:
+                chosen.append(i)
+                used += items[i][0]
+        return chosen
+    step = max(1, math.ceil(capacity / KNAPSACK_RESOLUTION))
+    slots = capacity // step
+    best = [0.0] * (slots + 1)
+    taken = []
+    for weight, value in items:
+        w = math.ceil(weight / step)
+        if w > slots:
+            taken.append(None)
+            continue
+        candidate = [0.0] * w + [best[c - w] + value for c in range(w, slots + 1)]
+        take = bytearray(c >= w and candidate[c] > best[c] for c in range(slots + 1))
+        best = [max(a, b) for a, b in zip(best, candidate)]
+        taken.append(take)
+    chosen, c = [], slots
+    for i in range(len(items) - 1, -1, -1):
+        if taken[i] is not None and taken[i][c]:
+            chosen.append(i)
+            c -= math.ceil(items[i][0] / step)
+    return chosen[::-1]
+
+def select_within_budget(planned_files, max_tokens, point_estimates=False):
+    candidates = [planned for planned in planned_files if planned.tokens is not None]
+    bounds = [
+        (planned.tokens, planned.tokens) if not planned.estimated or point_estimates else (planned.upper, planned.lower)
+        for planned in candidates
+    ]
+    chosen = set(knapsack([(upper, planned.score * planned.tokens) for planned, (upper, lower) in zip(candidates, bounds)], max_tokens))
+    selected = [planned for i, planned in enumerate(candidates) if i in chosen]
+    total_tokens = sum(bounds[i][0] for i in chosen)
+    # Files left out only because of estimate uncertainty are worth an exact count
+    boundary = [
+        planned for i, planned in enumerate(candidates)
+        if i not in chosen and bounds[i][0] != bounds[i][1] and total_tokens + bounds[i][1] <= max_tokens
+    ]
+    return selected, boundary, total_tokens
+
+def water_level(demands, capacity):
+    # The share every file not yet satisfied gets once smaller demands are met in full
+    remaining = capacity
+    ordered = sorted(demands)
+    for i, demand in enumerate(ordered):
+        share = remaining / (len(ordered) - i)
+        if demand > share:
+            return share
+        remaining -= demand
+    return math.inf
+
+def planned_upper(planned):
+    return planned.upper if planned.estimated else planned.tokens
+
+def full_demand(planned, estimator):
+    if not planned.truncated:
+        return planned_upper(planned)
+    file_type = TokenEstimator.file_type(planned.filepath, planned.mime_type)
+    return estimator.estimate(file_type, planned.size + WATER_FILL_HEADER_CHARS)[2]
+
+async def allocate_water_fill(planned_files, max_tokens, estimator, force_mime_type, manifest, io_semaphore, content_options):
+    # The segments of a chunked file share one allocation and are picked by value within it,
+    # and so do the files of a near-duplicate cluster, whose diffs need their representative
+    units = {}
+    for planned in planned_files:
+        key = planned.filepath if planned.segment else id(planned.near_duplicate[0]) if planned.near_duplicate else id(planned)
+        units.setdefault(key, []).append(planned)
+    units = list(units.values())
+    cap = content_options.token_cap or math.inf
+    demands = [sum(min(full_demand(planned, estimator), cap) for planned in unit) for unit in units]
+    # An excerpt never grows past what was already read, so a larger share would go unused
+    demands = [min(demand, planned_upper(units[i][0])) if units[i][0].excerpted else demand for i, demand in enumerate(demands)]
+    # Keep as many of the highest-value files as can each still get a useful share
+    order = sorted(range(len(units)), key=lambda i: max(planned.score for planned in units[i]), reverse=True)
+    low, high = 0, len(order)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if water_level([demands[i] for i in order[:middle]], max_tokens) >= WATER_FILL_MIN_TOKENS:
+            low = middle
+        else:
+            high = middle - 1
+    kept = order[:low]
+    level = water_level([demands[i] for i in kept], max_tokens)
+    if kept:
+        print(f"Water-fill level: {'unlimited' if level == math.inf else f'{int(level)} tokens per file'} across {len(kept)} files")
+
+    async def resize(planned, tail_bytes):
+        async with io_semaphore:
+            await prepare_planned_file(planned, force_mime_type, manifest, content_options, tail_bytes=tail_bytes)
+        if planned.content is not None and planned.tokens is None:
+            estimate_tokens(planned, estimator)
+
+    def shrink(planned):
+        # Size the tail window so even the worst-case estimate stays within the share
+        file_type = TokenEstimator.file_type(planned.filepath, planned.mime_type)
+        tokens_per_char = estimator.estimate(file_type, 1000000)[2] / 1000000
+        return resize(planned, max(1, int(level / tokens_per_char) - WATER_FILL_HEADER_CHARS))
+
+    resized, chosen = [], []
+    for i in kept:
+        if units[i][0].segment:
+            if demands[i] <= level:
+                chosen.extend(units[i])
+                continue
+            picked = select_within_budget(units[i], int(level))[0]
+            if not picked:
+                # Every segment is larger than the share: keep the tail of the most valuable one rather than none of the file
+                picked = [max(units[i], key=lambda planned: planned.score)]
+                resized.append(shrink(picked[0]))
+            chosen.extend(picked)
+            continue
+        if len(units[i]) > 1 and demands[i] > level:
+            # The representative stays whole while it fits, and the most valuable diffs fill the rest of the share
+            representative = next(planned for planned in units[i] if not planned.near_duplicate)
+            chosen.append(representative)
+            room = level - planned_upper(representative)
+            if room < 0:
+                resized.append(shrink(representative))
+                continue
+            for planned in sorted(units[i], key=lambda planned: planned.score, reverse=True):
+                if planned is not representative and planned_upper(planned) <= room:
+                    chosen.append(planned)
+                    room -= planned_upper(planned)
+            continue
+        if len(units[i]) > 1:
+            chosen.extend(units[i])
+            continue
+        planned = units[i][0]
+        chosen.append(planned)
+        if demands[i] > level:
+            resized.append(shrink(planned))
+        elif planned.truncated and not (planned.capped or planned.excerpted):
+            resized.append(resize(planned, planned.size))
+    await asyncio.gather(*resized)
+    # Excerpts keep their head and tail lines however small their share, so drop the least valuable files on overflow
+    return drop_to_budget([planned for planned in chosen if planned.content is not None], max_tokens)
+
+def drop_to_budget(planned_files, max_tokens):
+    chosen = sorted(planned_files, key=lambda planned: planned.score, reverse=True)
+    total = sum(planned_upper(planned) for planned in chosen)
+    while chosen and total > max_tokens:
+        total -= planned_upper(chosen.pop())
+    return chosen
+
+def split_into_segments(planned, segment_bytes):
+    try:
+        if os.stat(planned.filepath).st_size <= segment_bytes or bom_encoding(planned.filepath) not in (None, 'utf-8'):
+            return [planned]
+        segments = line_segments(planned.filepath, segment_bytes)
+    except (OSError, ValueError):
+        # Let the regular read report the problem
+        return [planned]
+    return [
+        PlannedFile(planned.filepath, planned.relative_path, planned.mime_type, segment=segment,
+                    display_name=f"{planned.relative_path} [lines {segment[0]}-{segment[1]}]")
+        for segment in segments
+    ]
+
+def timeline_lines(planned, alias, line_time):
+    # Lines without a timestamp (stack traces, wrapped messages) keep the time of the line before
+    timestamp = datetime.datetime.min
+    body = planned.content.partition('\n\n')[2]
+    for number, line in enumerate(body.split('\n')):
+        if not line or LINE_RANGE_PATTERN.match(line):
+            continue
+        parsed = line_time(line)
+        if parsed is not None:
+            # Sources with and without time zones are compared in UTC and wall-clock time respectively
+            timestamp = naive_time(parsed)
+        yield timestamp, alias, number, line
+
+def timeline_notes(planned):
+    # Everything a source's own header said about it (truncation, excerpt, time window) besides its name
+    header = planned.content.partition('\n\n')[0].split('\n')
+    notes = [line for line in header if line and not line.startswith(('File: ', 'Original Path: '))]
+    if planned.aliases:
+        notes.append("Identical copies: " + ", ".join(planned.aliases))
+    return notes
+
+def build_timeline(planned_files, directory, estimator, spare_tokens=0):
+    # Returns (timeline documents, files without timestamps). The merge holds one line per
+    # source at a time, plus the lines kept so far, so its memory is bounded by the budget.
+    sources, untimed = [], []
+    for planned in planned_files:
+        line_time = detect_line_time(planned.filepath)
+        if line_time is None:
+            untimed.append(planned)
+        else:
+            sources.append((planned, line_time))
+    if len(sources) < 2:
+        return [], untimed + [planned for planned, line_time in sources]
+
+    aliases = {id(planned): f"s{i + 1}" for i, (planned, line_time) in enumerate(sources)}
+    legend = "Sources:\n" + "".join(f"{aliases[id(planned)]}={planned.display_name}\n" + "".join(f"  {note}\n" for note in timeline_notes(planned))
+                                    for planned, line_time in sources)
+    # The sources' share of the budget plus what was left over, less a header per document, at the worst-case rate
+    tokens_per_char = estimator.estimate(TokenEstimator.file_type('timeline.log', 'text/plain'), 1000000)[2] / 1000000
+    budget_chars = (sum(planned_upper(planned) for planned, line_time in sources) + spare_tokens) / tokens_per_char
+    header_chars = len(legend) + 200
+    merged = heapq.merge(*[timeline_lines(planned, aliases[id(planned)], line_time) for planned, line_time in sources])
+    # Line prefixes make the merge larger than its sources, so the earliest lines go first, like a tail
+    kept, chars, dropped = collections.deque(), 0, 0
+    for timestamp, alias, number, line in merged:
+        kept.append(f"{alias}| {line}")
+        chars += len(kept[-1]) + 1
+        while kept and chars > budget_chars - header_chars * (1 + chars // TIMELINE_MAX_CHARS):
+            chars -= len(kept.popleft()) + 1
+            dropped += 1
+    if not kept:
+        return [], untimed + [planned for planned, line_time in sources]
+    documents, lines, chars = [], [], 0
+    for line in kept:
+        lines.append(line)
+        chars += len(line) + 1
+        if chars >= TIMELINE_MAX_CHARS:
+            documents.append("\n".join(lines))
+            lines, chars = [], 0
+    if lines:
+        documents.append("\n".join(lines))
+
+    note = f"Note: Lines from {len(sources)} files merged by timestamp; each line starts with its source alias.\n"
+    if dropped:
+        note += f"{TRUNCATION_NOTE}: the earliest {dropped} merged lines were left out to fit the token budget.\n"
+    paths = [path for planned, line_time in sources for path in [planned.relative_path] + planned.aliases]
+    timeline = []
+    for i, document in enumerate(documents):
+        name = f"timeline {i + 1} of {len(documents)}"
+        timeline.append(PlannedFile(os.path.join(directory, f"timeline-{i + 1}.log"), name, 'text/plain',
+                                    content=f"File: {name}\n" + note + legend + "\n" + document + "\n", sources=list(dict.fromkeys(paths))))
+    return timeline, untimed
+
+async def summarize_planned_file(planned, summarizer, force_mime_type, manifest):
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name=model_name)
-        file_response = upload_file_with_retry(filepath, relative_path, mime_type, force_mime_type=force_mime_type)
-        file_tokens = count_tokens_with_retry(model, file_response)
-        return file_response, file_tokens, None
+        summary = await asyncio.to_thread(summarizer.summarize, planned.filepath, planned.segment)
     except Exception as e:
-        print(f"Error processing {filepath}: {str(e)}")
-        return None, 0, filepath
+        print(f"Error summarizing {planned.display_name}, keeping it as it was: {str(e)}")
+        return
+    if summary is None:
+        return
+    metadata = planned.content.partition('\n')[0] + f"\nOriginal Path: {planned.filepath}\n"
+    covered = f"{planned.size} bytes" if planned.size <= SUMMARY_MAX_INPUT_BYTES else f"last {SUMMARY_MAX_INPUT_BYTES} of {planned.size} bytes"
+    planned.content = metadata + f"Note: This is a summary of the {covered} by {summarizer.model_name}, not the original text.\n\n" + summary + "\n"
+    planned.truncated = False
+    # Summaries aren't normalized, so none of the shrinkage is credited to normalization
+    planned.raw_chars = len(planned.content)
+    rekey(planned, manifest, force_mime_type)
+
+async def fit_to_token_cap(planned, cap, model, estimator, concurrency, force_mime_type, manifest, content_options, estimate_only=False):
+    if planned.tokens is None:
+        estimate_tokens(planned, estimator)
+    if (planned.upper if planned.estimated else planned.tokens) <= cap and not planned.truncated:
+        return
+    # Largest window whose worst-case estimate, header included, stays within the cap. The
+    # window is cut at a line boundary, so the search effectively runs over line offsets.
+    file_type = TokenEstimator.file_type(planned.filepath, planned.mime_type)
+    low, high = 0, planned.size
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimator.estimate(file_type, middle + WATER_FILL_HEADER_CHARS)[2] <= cap:
+            low = middle
+        else:
+            high = middle - 1
+    await prepare_planned_file(planned, force_mime_type, manifest, content_options, tail_bytes=max(1, low))
+    if planned.content is None:
+        return
+    planned.capped = True
+    if planned.tokens is None:
+        estimate_tokens(planned, estimator)
+    if planned.estimated and planned.upper > cap and content_options.excerpt:
+        # An excerpt always keeps its head and tail lines; below that size only a plain tail fits
+        content_options = dataclasses.replace(content_options, excerpt=None)
+        await prepare_planned_file(planned, force_mime_type, manifest, content_options, tail_bytes=max(1, low))
+        if planned.content is None:
+            return
+        if planned.tokens is None:
+            estimate_tokens(planned, estimator)
+    if estimate_only or not planned.estimated:
+        return
+    # The worst-case window usually counts well under the cap, so resize it by the measured rate,
+    # both ways, until a count lands close under the cap or the whole file fits
+    tail_bytes, fitted = max(1, low), None
+    for attempt in range(TOKEN_CAP_FIT_ROUNDS):
+        if planned.estimated:
+            await count_planned_batch(model, [planned], concurrency, estimator)
+            if planned.estimated:
+                return
+        measured = (tail_bytes, planned.tokens, planned.tokens / len(planned.content))
+        if planned.tokens <= cap:
+            fitted = (tail_bytes, planned.tokens)
+            if planned.tokens >= cap * TOKEN_CAP_FILL or not planned.truncated:
+                return
+        resized = max(1, min(planned.size, int(tail_bytes * cap * TOKEN_CAP_TARGET / planned.tokens)))
+        if resized == tail_bytes or attempt == TOKEN_CAP_FIT_ROUNDS - 1:
+            break
+        tail_bytes = resized
+        await prepare_planned_file(planned, force_mime_type, manifest, content_options, tail_bytes=tail_bytes)
+        if planned.content is None:
+            return
+        if planned.tokens is None:
+            estimate_tokens(planned, estimator)
+    if not planned.estimated and planned.tokens <= cap:
+        return
+    if fitted:
+        tail_bytes, tokens = fitted
+    else:
+        # Never under the cap: shrink once more by the measured rate, with a margin
+        tail_bytes, tokens = max(1, int(measured[0] * cap / measured[1] * 0.95)), None
+    await prepare_planned_file(planned, force_mime_type, manifest, content_options, tail_bytes=tail_bytes)
+    if planned.content is not None and planned.tokens is None:
+        planned.tokens = tokens or math.ceil(len(planned.content) * measured[2])
+        planned.estimated = False
+
+async def restore_near_duplicates(selected, reselect, estimator, force_mime_type, manifest, content_options):
+    # A diff only makes sense next to its whole representative. If that was dropped or cut to
+    # a tail window, the file goes up in full again and the selection is made again around it.
+    while True:
+        chosen = {id(planned) for planned in selected}
+        orphans = [planned for planned in selected if planned.near_duplicate and planned.content is planned.near_duplicate[2]
+                   and (id(planned.near_duplicate[0]) not in chosen or planned.near_duplicate[0].content is not planned.near_duplicate[1])]
+        if not orphans:
+            return selected
+        for planned in orphans:
+            print(f"Uploading {planned.display_name} in full: its near-duplicate {planned.near_duplicate[0].display_name} is not uploaded whole")
+            planned.near_duplicate = None
+            await prepare_planned_file(planned, force_mime_type, manifest, content_options)
+            if planned.content is not None and planned.tokens is None:
+                estimate_tokens(planned, estimator)
+        selected = reselect([planned for planned in selected if planned.content is not None])
 
-def upload_files(directory, model, api_key, force_mime_type=None, max_workers=5):
+def estimate_tokens(planned, estimator):
+    file_type = TokenEstimator.file_type(planned.filepath, planned.mime_type)
+    planned.tokens, planned.lower, planned.upper = estimator.estimate(file_type, len(planned.content))
+    planned.estimated = True
+
+async def plan_uploads(candidates, model, force_mime_type, manifest, estimator, concurrency, io_semaphore, max_tokens, start_upload, estimate_only=False, scoring=None, allocation='water-fill', content_options=None):
+    scoring = scoring or ScoringOptions()
+    content_options = content_options or ContentOptions()
+    readable, skipped_files, selected = [], [], []
+    committed_tokens = 0
+    blobs = {}
+    reserved_alias_tokens = 0
+    filtered_files = 0
+    samples_started = collections.Counter()
+    sample_tasks = []
+
+    async def prepare_and_commit(planned):
+        try:
+            parts = [planned]
+            if content_options.chunk_bytes and not (content_options.grep or content_options.time_window):
+                parts = await asyncio.to_thread(split_into_segments, planned, content_options.chunk_bytes)
+            for part in parts:
+                await prepare_planned_file(part, force_mime_type, manifest, content_options)
+        finally:
+            io_semaphore.release()
+        if content_options.summarizer:
+            # Outside the read slots: model calls take far longer and have their own concurrency cap
+            await asyncio.gather(*[summarize_planned_file(part, content_options.summarizer, force_mime_type, manifest)
+                                   for part in parts if part.content is not None and (part.truncated or part.segment and part.size >= SUMMARY_MIN_BYTES)])
+        if content_options.token_cap:
+            await asyncio.gather(*[fit_to_token_cap(part, content_options.token_cap, model, estimator, concurrency, force_mime_type, manifest, content_options, estimate_only)
+                                   for part in parts if part.content is not None])
+        for part in parts:
+            commit(part)
+
+    def commit(planned):
+        nonlocal committed_tokens, reserved_alias_tokens, filtered_files
+        if planned.filtered:
+            filtered_files += 1
+            return
+        if planned.content is None:
+            skipped_files.append(planned.filepath)
+            return
+        primary = blobs.setdefault((planned.digest, planned.mime_type), planned)
+        if primary is not planned:
+            # Same bytes under another path: its only cost is a line in the header of the one upload
+            primary.aliases.append(planned.relative_path)
+            alias_tokens = estimator.estimate(TokenEstimator.file_type(primary.filepath, primary.mime_type), len(planned.relative_path) + 2)[2]
+            primary.alias_tokens += alias_tokens
+            reserved_alias_tokens += alias_tokens
+            planned.content = None
+            return
+        if planned.tokens is None:
+            estimate_tokens(planned, estimator)
+        planned.score = score_file(planned, scoring)
+        # Files whose worst case still fits a share of the budget go straight to the uploader
+        # while the scan continues; the rest is chosen by value once the whole corpus is known
+        upper = planned.upper if planned.estimated else planned.tokens
+        # Truncated files wait for the allocator, which may give them more than the default tail
+        fast_path = not (allocation == 'water-fill' and planned.truncated) and not content_options.near_duplicates
+        if fast_path and committed_tokens + upper <= max_tokens * FAST_PATH_BUDGET_SHARE:
+            committed_tokens += upper
+            selected.append(planned)
+            start_upload(planned)
+            # Keep calibrating the estimator in the background even when everything fits
+            file_type = TokenEstimator.file_type(planned.filepath, planned.mime_type)
+            if planned.estimated and not estimate_only and not estimator.is_calibrated(file_type) and samples_started[file_type] < ESTIMATOR_MIN_SAMPLES:
+                samples_started[file_type] += 1
+                sample_tasks.append(asyncio.create_task(count_planned_batch(model, [planned], concurrency, estimator)))
+        else:
+            readable.append(planned)
+
+    pending = set()
+    failures = []
+
+    def finished(task):
+        pending.discard(task)
+        # A finished task leaves the set, so a fatal error would otherwise never reach the gather below
+        if not task.cancelled() and task.exception() is not None:
+            failures.append(task.exception())
+
+    async for planned in candidates:
+        await io_semaphore.acquire()
+        if failures:
+            io_semaphore.release()
+            break
+        task = asyncio.create_task(prepare_and_commit(planned))
+        pending.add(task)
+        task.add_done_callback(finished)
+    await asyncio.gather(*pending, return_exceptions=True)
+    if failures:
+        raise failures[0]
+    await asyncio.gather(*sample_tasks)
+
+    if content_options.near_duplicates:
+        # Only whole files are compared; a tail window says little about the rest of the file
+        clusters = await asyncio.to_thread(near_duplicate_clusters, [planned for planned in readable if not planned.truncated])
+        saved_chars = diffed = 0
+        for cluster in clusters:
+            representative = max(cluster, key=lambda planned: (planned.score, len(planned.content)))
+            reference = {masked for line, masked in masked_lines(representative.content, DIGIT_PATTERN)}
+            for planned in cluster:
+                if planned is representative:
+                    continue
+                content = near_duplicate_content(planned, representative, reference)
+                if len(content) > len(planned.content) * NEAR_DUPLICATE_MAX_DIFF_RATIO:
+                    # Not worth depending on the representative for; uploaded whole like any other file
+                    continue
+                saved_chars += len(planned.content) - len(content)
+                diffed += 1
+                planned.content = content
+                planned.raw_chars = len(planned.content)
+                rekey(planned, manifest, force_mime_type)
+                if planned.tokens is None:
+                    estimate_tokens(planned, estimator)
+                planned.near_duplicate = (representative, representative.content, planned.content)
+        if diffed:
+            print(f"Uploading {diffed} of {sum(len(cluster) for cluster in clusters)} files in {len(clusters)} near-duplicate clusters as diffs, "
+                  f"leaving out {saved_chars} characters they share with their representative")
+
+    # Exact single-file counts for types the estimator hasn't seen enough of yet
+    if readable and not estimate_only:
+        to_sample = list(calibration_samples([planned for planned in readable if planned.estimated], estimator))
+        await asyncio.gather(*[count_planned_batch(model, [planned], concurrency, estimator) for planned in to_sample])
+        for planned in readable:
+            if planned.estimated:
+                estimate_tokens(planned, estimator)
+
+    # Accept files whose worst case fits, rule out files whose best case can't, and only
+    # ask the API about the ones in between. Background samples may have tightened the
+    # bounds of files already committed, which frees budget for the rest.
+    committed_tokens = sum(planned.upper if planned.estimated else planned.tokens for planned in selected)
+    remaining_tokens = max_tokens - committed_tokens - reserved_alias_tokens
+    if allocation == 'water-fill':
+        late_selected = await allocate_water_fill(readable, remaining_tokens, estimator, force_mime_type, manifest, io_semaphore, content_options)
+        boundary = []
+    else:
+        late_selected, boundary, _ = select_within_budget(readable, remaining_tokens)
+    if boundary and not estimate_only:
+        print(f"Counting {len(boundary)} files near the token budget boundary")
+        await asyncio.gather(*[count_planned_batch(model, batch, concurrency, estimator) for batch in batch_for_counting(boundary)])
+        late_selected, boundary, _ = select_within_budget(readable, remaining_tokens)
+    if estimate_only and allocation != 'water-fill':
+        # Without any counting, trust the point estimates for files near the boundary
+        late_selected, boundary, _ = select_within_budget(readable, remaining_tokens, point_estimates=True)
+
+    if content_options.near_duplicates:
+        if allocation == 'water-fill':
+            reselect = lambda selected: drop_to_budget(selected, remaining_tokens)
+        else:
+            reselect = lambda selected: select_within_budget(readable, remaining_tokens, point_estimates=estimate_only)[0]
+        late_selected = await restore_near_duplicates(late_selected, reselect, estimator, force_mime_type, manifest, content_options)
+
+    selected_ids = {id(planned) for planned in late_selected}
+    for planned in readable:
+        if id(planned) in selected_ids:
+            selected.append(planned)
+            start_upload(planned)
+        else:
+            print(f"Skipping {planned.display_name}: Would exceed token limit")
+            skipped_files.append(planned.display_name)
+            skipped_files.extend(planned.aliases)
+            planned.content = None
+
+    if filtered_files:
+        print(f"Left out {filtered_files} files with no lines passing the content filters")
+    if content_options.summarizer:
+        content_options.summarizer.report()
+    duplicates = sum(len(planned.aliases) for planned in selected)
+    if duplicates:
+        print(f"Deduplicated {duplicates} files with the same content as another file")
+    for planned in selected:
+        planned.tokens += planned.alias_tokens
+    total_tokens = sum(planned.tokens for planned in selected)
+    if content_options.normalize:
+        saved_tokens = 0
+        for planned in selected:
+            if planned.raw_chars == len(planned.content):
+                continue
+            # Same tokens-per-character rate before and after, so this understates what stripped escape codes save
+            before = round(planned.tokens * planned.raw_chars / max(1, len(planned.content)))
+            saved_tokens += before - planned.tokens
+            print(f"Normalized {planned.display_name}: ~{before} -> {planned.tokens} tokens")
+        print(f"Normalization saved ~{saved_tokens} tokens")
+    estimated = [planned for planned in selected if planned.estimated]
+    if estimated:
+        margin = sum(planned.upper - planned.tokens for planned in estimated)
+        print(f"{len(estimated)} of {len(selected)} files use estimated token counts (up to +{margin} tokens)")
+        estimator.report({TokenEstimator.file_type(planned.filepath, planned.mime_type) for planned in estimated})
+    print(f"Planned {len(selected)} files for upload (Tokens: {total_tokens}/{max_tokens})")
+    return selected, skipped_files
+
+async def upload_planned_file(planned, force_mime_type, manifest, concurrency):
+    async with concurrency:
+        try:
+            # Duplicates found while this file waited for a slot still make it into the header
+            aliases = list(planned.aliases)
+            content = with_aliases(planned.content, aliases)
+            key, cached_name = planned.key, planned.cached_name
+            if manifest and aliases:
+                key = manifest_key(content, force_mime_type or planned.mime_type)
+                cached_name = (manifest.lookup(key) or (None,))[0]
+            if cached_name:
+                try:
+                    file_response = manifest.live_files.get(cached_name) or await asyncio.to_thread(get_remote_file, cached_name)
+                    file_response.text = content
+                    file_response.paths = planned.sources or [planned.relative_path] + aliases
+                    file_response.merged = bool(planned.sources)
+                    print(f"Reusing {planned.display_name} from previous upload {cached_name} (Tokens: {planned.tokens})")
+                    return planned, file_response
+                except google_exceptions.NotFound:
+                    manifest.forget(cached_name)
+            file_response = await asyncio.to_thread(upload_file_with_retry, planned.filepath, planned.display_name, planned.mime_type, force_mime_type=force_mime_type, full_content=content, observer=concurrency.observer('upload'))
+            file_response.paths = planned.sources or [planned.relative_path] + aliases
+            file_response.merged = bool(planned.sources)
+            if manifest:
+                manifest.record(key, file_response, planned.tokens, planned.upper if planned.estimated else None)
+            return planned, file_response
+        except Exception as e:
+            print(f"Error processing {planned.filepath}: {str(e)}")
+            return planned, None
+
+async def upload_files_async(directory, model, force_mime_type=None, max_workers=5, max_concurrency=200, cache_dir=None, estimate_only=False, scan_options=None, paths=None, max_tokens=DEFAULT_TOKEN_BUDGET, scoring=None, allocation='water-fill', content_options=None):
     uploaded_files = []
-    skipped_files = []
     total_tokens = 0
-    max_tokens = 2000000  # 2M token limit
+    content_options = content_options or ContentOptions()
 
-    files_to_process = [
-        (filepath, os.path.relpath(filepath, directory), get_mime_type(filepath), force_mime_type, model.model_name, api_key)
-        for filepath in glob.glob(f"{directory}/**/*", recursive=True)
-        if os.path.isfile(filepath)
-    ]
+    # Uploads are network-bound, so one process with a bounded number of in-flight
+    # requests shares the configured clients instead of re-creating them per file.
+    # The bound starts at max_workers and adapts to throttling and latency.
+    max_concurrency = max(max_concurrency, max_workers)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+    concurrency = AdaptiveConcurrency(max_workers, max_concurrency)
+    io_semaphore = asyncio.Semaphore(max_workers)
+
+    manifest = None
+    if cache_dir:
+        manifest = UploadManifest(cache_dir)
+        live_files = await asyncio.to_thread(list_uploaded_files)
+        if live_files is None:
+            # Keep the entries: each one is still checked against the API before it is reused
+            print(f"Upload cache: could not list remote files, using {manifest.path} without validating it")
+        else:
+            manifest.validate(live_files)
+            live_entries = manifest.conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+            print(f"Upload cache: {live_entries} reusable remote files in {manifest.path}")
+    estimator = TokenEstimator(cache_dir)
+
+    loop = asyncio.get_running_loop()
+    scan_queue = asyncio.Queue(maxsize=SCAN_QUEUE_BATCHES)
+
+    def emit(batch):
+        # Blocks the scanner thread when the planner falls behind, so the work list never piles up in memory
+        asyncio.run_coroutine_threadsafe(scan_queue.put(batch), loop).result()
+
+    async def candidates():
+        while (batch := await scan_queue.get()) is not None:
+            for filepath in batch:
+                yield PlannedFile(filepath, os.path.relpath(filepath, directory), get_mime_type(filepath))
+
+    upload_tasks = []
+    timeline_candidates = []
 
-    with multiprocessing.Pool(processes=max_workers) as pool:
-        results = pool.map(process_file, files_to_process)
+    def start_upload(planned):
+        if content_options.timeline:
+            # Held back until the selection is final, then merged into a few documents
+            timeline_candidates.append(planned)
+            return
+        upload_tasks.append(asyncio.create_task(upload_planned_file(planned, force_mime_type, manifest, concurrency)))
 
-    for file_response, file_tokens, error_filepath in results:
-        if error_filepath:
-            skipped_files.append(error_filepath)
-        elif total_tokens + file_tokens > max_tokens:
-            print(f"Skipping {file_response.display_name}: Would exceed token limit")
-            skipped_files.append(file_response.display_name)
-            genai.delete_file(name=file_response.name)
+    if paths is None:
+        scan = asyncio.create_task(asyncio.to_thread(scan_directory, directory, emit, scan_options))
+    else:
+        scan = None
+        scan_queue.put_nowait(list(paths))
+        scan_queue.put_nowait(None)
+    # Decide what fits the budget from the local text first, so nothing is uploaded only to be deleted again.
+    # Files that fit even in the worst case start uploading while the rest is still being scanned.
+    selected, skipped_files = await plan_uploads(candidates(), model, force_mime_type, manifest, estimator, concurrency, io_semaphore, max_tokens, start_upload, estimate_only=estimate_only, scoring=scoring, allocation=allocation, content_options=content_options)
+    if scan:
+        scan_stats = await scan
+        filtered = ", ".join(f"{count} {reason}" for reason, count in sorted(scan_stats.items()) if reason != 'files')
+        print(f"Scanned {scan_stats['files']} files{f' (skipped: {filtered})' if filtered else ''}")
+
+    if timeline_candidates:
+        spare_tokens = max(0, max_tokens - sum(planned_upper(planned) for planned in selected))
+        timeline, untimed = await asyncio.to_thread(build_timeline, timeline_candidates, directory, estimator, spare_tokens)
+        for planned in timeline:
+            rekey(planned, manifest, force_mime_type)
+            if planned.tokens is None:
+                estimate_tokens(planned, estimator)
+        if timeline and not estimate_only:
+            await asyncio.gather(*[count_planned_batch(model, batch, concurrency) for batch in batch_for_counting([planned for planned in timeline if planned.estimated])])
+        if timeline:
+            print(f"Merged {len(timeline_candidates) - len(untimed)} files into {len(timeline)} timeline documents "
+                  f"(Tokens: {sum(planned.tokens for planned in timeline)})")
+        for planned in timeline + untimed:
+            upload_tasks.append(asyncio.create_task(upload_planned_file(planned, force_mime_type, manifest, concurrency)))
+
+    for next_result in asyncio.as_completed(upload_tasks):
+        planned, file_response = await next_result
+        if file_response is not None and len(file_response.paths) <= len(planned.aliases):
+            # A copy turned up after this file was sent, so send it again with the full list of paths
+            stale_response = file_response
+            planned, file_response = await upload_planned_file(planned, force_mime_type, manifest, concurrency)
+            if file_response is not None:
+                await asyncio.to_thread(cleanup_files, [stale_response])
+                if manifest:
+                    manifest.forget(stale_response.name)
+            else:
+                file_response = stale_response
+        planned.content = None
+        if file_response is None:
+            skipped_files.append(planned.filepath)
         else:
+            file_response.tokens = planned.tokens
             uploaded_files.append(file_response)
-            total_tokens += file_tokens
-            print(f"Processed file {file_response.display_name} (Tokens: {file_tokens})")
+            total_tokens += planned.tokens
+            print(f"Processed file {file_response.display_name} (Tokens: {planned.tokens})")
             print(f"Total tokens used: {total_tokens}/{max_tokens}")
 
+    concurrency.report()
+    estimator.close()
+    if manifest:
+        manifest.close()
+    if content_options.grep:
+        content_options.grep.close()
     return uploaded_files, skipped_files, total_tokens
 
+def upload_files(directory, model, force_mime_type=None, max_workers=5, max_concurrency=200, cache_dir=None, estimate_only=False, scan_options=None, paths=None, max_tokens=DEFAULT_TOKEN_BUDGET, scoring=None, allocation='water-fill', content_options=None):
+    return asyncio.run(upload_files_async(directory, model, force_mime_type=force_mime_type, max_workers=max_workers, max_concurrency=max_concurrency, cache_dir=cache_dir, estimate_only=estimate_only, scan_options=scan_options, paths=paths, max_tokens=max_tokens, scoring=scoring, allocation=allocation, content_options=content_options))
+
+def get_remote_file(name):
+    rate_limiter.acquire()
+    return genai.get_file(name)
+
+def delete_remote_file(name):
+    rate_limiter.acquire()
+    genai.delete_file(name=name)
+
 def cleanup_files(uploaded_files, max_workers=10):
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(genai.delete_file, name=file.name) for file in uploaded_files]
+        futures = [executor.submit(delete_remote_file, file.name) for file in uploaded_files]
         for future, file in zip(futures, uploaded_files):
             try:
                 future.result()
@@ -144,11 +2328,173 @@ def cleanup_files(uploaded_files, max_workers=10):
             except Exception as e:
                 print(f"Failed to delete {file.display_name}: {str(e)}")
 
-def chat_with_model(model, system_prompt, uploaded_files, use_history=True):
+def snapshot_directory(directory, scan_options=None):
+    # Not sniffed: reading the start of every file on each pass would cost more than the scan itself
+    files = []
+    scan_directory(directory, lambda batch: files.extend(batch or []), dataclasses.replace(scan_options or ScanOptions(), sniff=False))
+    snapshot = {}
+    for filepath in files:
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            continue
+        snapshot[filepath] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+class InotifyTrigger:
+    # Linux inotify through libc; only used to wake up early; the actual changes come from snapshot diffs
+    MASK = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400  # MODIFY, CLOSE_WRITE, MOVED_FROM/TO, CREATE, DELETE, DELETE_SELF
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, directories):
+        for directory in directories - self.watched:
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK) >= 0:
+                self.watched.add(directory)
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchSession:
+    def __init__(self, directory, model, upload_options, scan_options=None, max_tokens=DEFAULT_TOKEN_BUDGET, interval=5.0):
+        self.directory = directory
+        self.model = model
+        self.upload_options = upload_options
+        self.scan_options = scan_options
+        self.max_tokens = max_tokens
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.files = {}
+        self.generation = 0
+        # Baseline before the initial upload, so changes made while it runs are picked up too
+        self.snapshot = snapshot_directory(directory, scan_options)
+        try:
+            self.trigger = InotifyTrigger()
+        except (OSError, AttributeError):
+            print("inotify unavailable, watching for changes by polling")
+            self.trigger = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, uploaded_files):
+        self.add(uploaded_files)
+        self.thread.start()
+
+    def add(self, uploaded_files):
+        # A path can be covered by several uploads (segments) and an upload by several paths (identical copies)
+        for file in uploaded_files:
+            for path in file.paths:
+                self.files.setdefault(os.path.join(self.directory, path), []).append(file)
+
+    def uploads(self, paths=None):
+        files = (file for path in (self.files if paths is None else paths) for file in self.files.get(path, []))
+        return list({id(file): file for file in files}.values())
+
+    def current(self):
+        with self.lock:
+            files = self.uploads()
+            return files, sum(getattr(file, 'tokens', 0) for file in files), self.generation
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        if self.trigger:
+            self.trigger.close()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            if self.trigger:
+                self.trigger.watch({os.path.dirname(path) for path in self.snapshot} | {self.directory})
+                # Fall back to a full rescan now and then to catch files in directories created since
+                deadline = time.monotonic() + self.interval * 6
+                while not self.stopping.is_set() and time.monotonic() < deadline:
+                    if self.trigger.wait(1.0):
+                        break
+            if self.stopping.wait(self.interval):
+                break
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"\nError syncing changes: {str(e)}")
+
+    @staticmethod
+    def unsupported(path):
+        # Only new and changed files are sniffed; an unreadable one is left for the upload to report
+        try:
+            return sniff_file(path) is not None
+        except OSError:
+            return False
+
+    def sync(self):
+        snapshot = snapshot_directory(self.directory, self.scan_options)
+        added = [path for path in snapshot if path not in self.snapshot]
+        modified = [path for path in snapshot if path in self.snapshot and snapshot[path] != self.snapshot[path]]
+        deleted = [path for path in self.snapshot if path not in snapshot]
+        self.snapshot = snapshot
+        if not (added or modified or deleted):
+            return
+
+        with self.lock:
+            stale = self.uploads(modified + deleted)
+        # Unchanged copies of a changed file lose their shared upload and need one of their own
+        orphaned = [path for file in stale for path in (os.path.join(self.directory, alias) for alias in file.paths)
+                    if path in snapshot and path not in modified]
+        print(f"\nDetected {len(added)} added, {len(modified)} modified and {len(deleted)} deleted files, syncing...")
+        if stale:
+            cleanup_files(stale)
+            if self.upload_options.get('cache_dir'):
+                manifest = UploadManifest(self.upload_options['cache_dir'])
+                for file in stale:
+                    manifest.forget(file.name)
+                manifest.close()
+
+        with self.lock:
+            for path in modified + deleted + orphaned:
+                self.files.pop(path, None)
+            used_tokens = sum(getattr(file, 'tokens', 0) for file in self.uploads())
+        changed = added + modified
+        if self.scan_options is None or self.scan_options.sniff:
+            changed = [path for path in changed if not self.unsupported(path)]
+        uploaded, skipped, _ = upload_files(self.directory, self.model, paths=changed + orphaned,
+                                            max_tokens=self.max_tokens - used_tokens, **self.upload_options)
+        with self.lock:
+            self.add(uploaded)
+            self.generation += 1
+        print(f"Synced {len(uploaded)} files, removed {len(stale)} stale copies" + (f", skipped {len(skipped)}" if skipped else ""))
+
+
+def describe_files(uploaded_files):
+    return "The following files are available for reference:\n" + "\n".join(
+        [f"- {file.display_name}" + (f" (merged from: {', '.join(file.paths)})" if file.merged else
+                                      f" (identical copies: {', '.join(file.paths[1:])})" if len(file.paths) > 1 else "") for file in uploaded_files])
+
+def chat_with_model(model, system_prompt, uploaded_files, use_history=True, context_tokens=0, watch_session=None):
     print("Chat started. Type 'exit' or press Ctrl+D to end the conversation.")
     print("AI: Hello! I'm ready to help you with any questions about the uploaded files. What would you like to know?")
 
-    file_info = "The following files are available for reference:\n" + "\n".join([f"- {file.display_name}" for file in uploaded_files])
+    file_info = describe_files(uploaded_files)
+    generation = 0
 
     safety_settings = {
         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -172,6 +2518,18 @@ def chat_with_model(model, system_prompt, uploaded_files, use_history=True):
                 if user_input.lower() == 'exit':
                     break
                 
+                if watch_session:
+                    files, tokens, current_generation = watch_session.current()
+                    if current_generation != generation:
+                        # Swap the file list the model sees, keeping the conversation so far
+                        uploaded_files, context_tokens, generation = files, tokens, current_generation
+                        file_info = describe_files(uploaded_files)
+                        if use_history:
+                            first_turn = {"role": "user", "parts": [system_prompt, file_info] + uploaded_files}
+                            chat = model.start_chat(history=[first_turn] + list(chat.history[1:]))
+
+                # Every turn resends the uploaded files (and, with history, the conversation so far)
+                rate_limiter.acquire(tokens=context_tokens + len(user_input) // 4)
                 if use_history:
                     response = chat.send_message(user_input, stream=True, safety_settings=safety_settings)
                 else:
@@ -200,22 +2558,34 @@ def chat_with_model(model, system_prompt, uploaded_files, use_history=True):
 
     print("Chat ended.")
 
-def list_uploaded_files():
-    try:
-        return genai.list_files()
-    except Exception as e:
-        print(f"An error occurred while listing files: {e}")
-        return []
+def list_uploaded_files(max_retries=5, base_wait_time=5):
+    # list_files() pages lazily, so the requests only happen while the list is built
+    wait_time = base_wait_time
+    for attempt in range(max_retries):
+        retry_policy.before_attempt()
+        try:
+            rate_limiter.acquire()
+            files = list(genai.list_files())
+            retry_policy.record_success()
+            return files
+        except Exception as e:
+            print(f"An error occurred while listing files: {e}")
+            wait_time = retry_policy.next_wait(e, attempt, max_retries, wait_time, base_wait_time)
+            if wait_time is None:
+                return None
+            print(f"Retrying in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+    return None
 
 def delete_file(file_id):
     try:
-        genai.delete_file(file_id)
+        delete_remote_file(file_id)
         print(f"File with ID {file_id} has been successfully deleted.")
     except Exception as e:
         print(f"An error occurred while deleting file {file_id}: {e}")
 
 def cleanup_all_files(max_workers=10):
-    files = list_uploaded_files()
+    files = list_uploaded_files() or []
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = [executor.submit(delete_file, file.name) for file in files]
         for future in as_completed(futures):
@@ -225,8 +2595,59 @@ def main():
     parser = argparse.ArgumentParser(description="Upload files and chat with Gemini model.")
     parser.add_argument("directory", help="Directory containing files to upload")
     parser.add_argument("--force-mime", help="Force all files to use this MIME type")
-    parser.add_argument("--max-workers", type=int, default=20, help="Maximum number of parallel uploads")
+    parser.add_argument("--max-workers", type=int, default=20, help="Initial number of concurrent API requests")
+    parser.add_argument("--max-concurrency", type=int, default=200, help="Upper bound for the adaptive number of concurrent API requests")
     parser.add_argument("--no-history", action="store_true", help="Do not maintain chat history between queries")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory for the persistent upload manifest")
+    parser.add_argument("--no-cache", action="store_true", help="Always upload fresh copies and delete them on exit")
+    parser.add_argument("--estimate-only", action="store_true", help="Plan the token budget from the offline estimator without calling count_tokens")
+    parser.add_argument("--include", action="append", default=[], help="Only upload files matching this .gitignore-style pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], help="Skip files and directories matching this .gitignore-style pattern (repeatable)")
+    parser.add_argument("--ignore-file", help="File of .gitignore-style exclude patterns")
+    parser.add_argument("--max-depth", type=int, help="Maximum directory depth to descend into")
+    parser.add_argument("--max-file-size", type=int, help="Skip files larger than this many bytes")
+    parser.add_argument("--symlinks", choices=["skip", "files", "follow"], default="follow", help="Which symbolic links to follow while scanning")
+    parser.add_argument("--no-sniff", dest="sniff", action="store_false",
+                        help="Don't skip files whose first few KB look binary or aren't UTF-8 text")
+    parser.add_argument("--budget", type=int, default=DEFAULT_TOKEN_BUDGET, help="Total token budget for the uploaded files")
+    parser.add_argument("--allocation", choices=["water-fill", "knapsack"], default="water-fill",
+                        help="Share the budget across files as tail windows (water-fill) or include/skip whole files (knapsack)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="Strip ANSI codes, collapse whitespace, rewrite timestamps as deltas and alias repeated IDs before upload")
+    parser.add_argument("--templates", action="store_true",
+                        help="Summarize files too large to upload whole as log line templates with counts, time spans and example values")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="Upload files that are almost identical once, plus only the lines that differ for the other copies")
+    parser.add_argument("--chunk-size", type=int, metavar="BYTES",
+                        help="Split files larger than this into line-aligned segments and let the budget pick which segments to upload")
+    parser.add_argument("--excerpt", action="store_true",
+                        help="Show files too large to upload whole as their head, tail and the lines around errors instead of only their tail")
+    parser.add_argument("--severity-pattern", action="append", default=[], metavar="REGEX",
+                        help="Lines the excerpt is built around (repeatable, defaults to ERROR/FATAL, tracebacks, panics and out-of-memory errors)")
+    parser.add_argument("--excerpt-context", type=int, default=5, help="Lines of context kept before and after each matching line")
+    parser.add_argument("--excerpt-tokens", type=int, default=8000, help="Token cap for each excerpt")
+    parser.add_argument("--grep", metavar="PATTERN", help="Upload only the lines matching this regular expression, from every scanned file")
+    parser.add_argument("-C", "--grep-context", type=int, default=0, metavar="N", help="Lines of context around each --grep match")
+    parser.add_argument("--since", help="Upload only log lines at or after this time (ISO 8601) from files with timestamps")
+    parser.add_argument("--until", help="Upload only log lines at or before this time (ISO 8601) from files with timestamps")
+    parser.add_argument("--timeline", action="store_true",
+                        help="Merge the selected time-stamped files into a few time-ordered documents, tagging each line with its source")
+    parser.add_argument("--summarize", action="store_true",
+                        help="Upload summaries from a cheaper model in place of files (or --chunk-size segments) too large to upload whole")
+    parser.add_argument("--summary-model", default="models/gemini-1.5-flash-latest", help="Model used by --summarize")
+    parser.add_argument("--summary-concurrency", type=int, default=4, help="Most summaries requested at once")
+    parser.add_argument("--summary-max-tokens", type=int, default=1000000, help="Cap on the input tokens sent for summaries in one run")
+    parser.add_argument("--per-file-token-cap", type=int, metavar="TOKENS",
+                        help="Tokens each file may use; files too large to upload whole get the largest tail (or excerpt) that fits")
+    parser.add_argument("--priority", action="append", default=[], metavar="PATTERN=WEIGHT", help="Weight files matching a .gitignore-style pattern when the budget is tight (repeatable)")
+    parser.add_argument("--type-weight", action="append", default=[], metavar="EXT=WEIGHT", help="Weight files by extension, e.g. .log=2 (repeatable)")
+    parser.add_argument("--recency-weight", type=float, default=1.0, help="How strongly recently modified files are preferred")
+    parser.add_argument("--error-weight", type=float, default=1.0, help="How strongly files with many error lines are preferred")
+    parser.add_argument("--watch", action="store_true", help="Keep uploads in sync with changes to the directory during the chat")
+    parser.add_argument("--watch-interval", type=float, default=5.0, help="Minimum seconds between syncs in watch mode")
+    parser.add_argument("--rpm", type=int, help="API requests per minute shared by all gemini.py processes on this host")
+    parser.add_argument("--bytes-per-minute", type=int, help="Upload bytes per minute shared by all gemini.py processes on this host")
+    parser.add_argument("--tpm", type=int, help="Prompt tokens per minute for chat requests shared by all gemini.py processes on this host")
     args = parser.parse_args()
 
     api_key = os.environ.get("GEMINI_API_KEY")
@@ -234,17 +2655,46 @@ def main():
         raise ValueError("GEMINI_API_KEY environment variable is not set")
 
     genai.configure(api_key=api_key)
+    rate_limiter.configure(args.cache_dir, requests_per_minute=args.rpm, bytes_per_minute=args.bytes_per_minute, tokens_per_minute=args.tpm)
     model_name = "models/gemini-1.5-pro-latest"
     model = genai.GenerativeModel(model_name=model_name)
 
     #print("Cleaning up any existing files...")
     #cleanup_all_files(max_workers=args.max_workers)
 
+    cache_dir = None if args.no_cache else args.cache_dir
+    scoring = ScoringOptions(priority=parse_weights(args.priority), type_weights=dict(parse_weights(args.type_weight)),
+                             recency_weight=args.recency_weight, error_weight=args.error_weight)
+    scan_options = ScanOptions(include=args.include, exclude=args.exclude, ignore_file=args.ignore_file,
+                               max_depth=args.max_depth, max_file_size=args.max_file_size, symlinks=args.symlinks,
+                               sniff=args.sniff)
+
+    time_window = None
+    if args.since or args.until:
+        time_window = TimeWindow(since=args.since and parse_timestamp(args.since), until=args.until and parse_timestamp(args.until))
+        if (args.since and time_window.since is None) or (args.until and time_window.until is None):
+            parser.error("--since and --until take ISO 8601 times, e.g. 2024-05-01T10:00:00")
+    if args.timeline and args.normalize:
+        parser.error("--timeline can't be combined with --normalize, which rewrites the timestamps it merges on")
+    excerpt = ExcerptOptions(patterns=args.severity_pattern or list(EXCERPT_DEFAULT_PATTERNS), context=args.excerpt_context,
+                             max_tokens=args.excerpt_tokens) if args.excerpt else None
+    summarizer = Summarizer(args.summary_model, cache_dir, concurrency=args.summary_concurrency,
+                            max_input_tokens=args.summary_max_tokens) if args.summarize else None
+    content_options = ContentOptions(normalize=args.normalize, templates=args.templates, near_duplicates=args.near_duplicates,
+                                     chunk_bytes=args.chunk_size, excerpt=excerpt,
+                                     grep=GrepOptions(args.grep, context=args.grep_context) if args.grep else None, time_window=time_window,
+                                     timeline=args.timeline, summarizer=summarizer, token_cap=args.per_file_token_cap)
+
+    upload_options = dict(force_mime_type=args.force_mime, max_workers=args.max_workers, max_concurrency=args.max_concurrency,
+                          cache_dir=cache_dir, estimate_only=args.estimate_only, scan_options=scan_options, scoring=scoring,
+                          allocation=args.allocation, content_options=content_options)
+    watch_session = WatchSession(args.directory, model, upload_options, scan_options, max_tokens=args.budget, interval=args.watch_interval) if args.watch else None
+
     uploaded_files = []
     try:
-        uploaded_files, skipped_files, total_tokens = upload_files(args.directory, model, api_key, force_mime_type=args.force_mime, max_workers=args.max_workers)
+        uploaded_files, skipped_files, total_tokens = upload_files(args.directory, model, max_tokens=args.budget, **upload_options)
 
-        if total_tokens >= 2000000:
+        if total_tokens >= args.budget:
             print("Warning: Maximum token limit reached. Some files may have been skipped.")
 
         if skipped_files:
@@ -256,11 +2706,20 @@ def main():
                          "When the user asks a question, you can analyze and refer to these files to provide information. "
                          "The files need to be cross referenced they each only contain partial information. " )
 
-        chat_with_model(model, system_prompt, uploaded_files, use_history=not args.no_history)
+        if watch_session:
+            watch_session.start(uploaded_files)
+        chat_with_model(model, system_prompt, uploaded_files, use_history=not args.no_history, context_tokens=total_tokens, watch_session=watch_session)
 
     finally:
-        print("Cleaning up uploaded files...")
-        cleanup_files(uploaded_files, max_workers=args.max_workers)
+        if watch_session and watch_session.thread.is_alive():
+            watch_session.stop()
+            uploaded_files = watch_session.current()[0]
+        if cache_dir:
+            # Remote files expire on their own; keeping them lets the next session reuse them
+            print(f"Keeping {len(uploaded_files)} uploaded files for reuse (manifest in {cache_dir})")
+        else:
+            print("Cleaning up uploaded files...")
+            cleanup_files(uploaded_files, max_workers=args.max_workers)
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()  # Needed for Windows compatibility
@@ -0,0 +1,28 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gemini
+
+
+def test_water_fill_keeps_a_tail_of_a_chunked_file_larger_than_its_share(tmp_path):
+    log = tmp_path / "big.log"
+    log.write_text("".join(f"2024-01-01 00:00:{i % 60:02d} INFO request {i} handled\n" for i in range(20000)))
+    estimator = gemini.TokenEstimator()
+    content_options = gemini.ContentOptions(chunk_bytes=100000)
+
+    async def allocate():
+        planned = gemini.PlannedFile(str(log), "big.log", "text/plain")
+        segments = gemini.split_into_segments(planned, content_options.chunk_bytes)
+        for segment in segments:
+            await gemini.prepare_planned_file(segment, None, None, content_options)
+            gemini.estimate_tokens(segment, estimator)
+        assert len(segments) > 1 and all(gemini.planned_upper(segment) > 5000 for segment in segments)
+        return await gemini.allocate_water_fill(segments, 5000, estimator, None, None, asyncio.Semaphore(1), content_options)
+
+    chosen = asyncio.run(allocate())
+    assert len(chosen) == 1
+    assert chosen[0].segment and chosen[0].truncated
+    assert gemini.planned_upper(chosen[0]) <= 5000